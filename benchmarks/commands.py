@@ -0,0 +1,510 @@
+#!/usr/bin/env python3
+
+'''
+Times every GackRepo command against a synthetic stacked repo.
+
+A template repo is generated once (see synthetic.py); every benchmark runs on
+a fresh copy of it, so commands that rewrite the stack do not affect the
+ones that follow. Besides wall time, each result counts the git processes
+the command spawned, whether through gack's own plumbing, GitPython or a
+shell-out. `arc` is replaced by a stub that succeeds without doing anything
+but hand out a revision for `arc diff --create` and note what it was asked
+to upload.
+
+Some benchmarks also check what the command did, once it has been timed.
+
+    python3 benchmarks/commands.py [--json OUT] [--runs 3] [synthetic.py options]
+
+Compare the JSON of two commits to spot regressions. Exits non-zero if any
+check fails.
+'''
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from gack import GackRepo
+from synthetic import add_arguments, make_stacked_repo, repo_options
+
+# Stands in for arc: `diff --create` hands out a revision, every diff appends
+# its head and base to .git/arc-diffs, and `land` squashes the branch onto its
+# target and pushes that, as `arc land` does
+STUB_ARC = '''#!/bin/sh
+command=$1
+shift
+case "$command" in
+  diff)
+    for arg in "$@"; do
+      [ "$previous" = --head ] && head=$arg
+      previous=$arg
+    done
+    echo "$head $arg" >> "$(git rev-parse --git-dir)/arc-diffs"
+    case " $* " in
+      *" --create "*) echo "Revision URI: https://phab.example.com/D$$" ;;
+    esac
+    ;;
+  land)
+    onto=master
+    branch=$(git symbolic-ref --short HEAD)
+    while [ $# -gt 0 ]; do
+      case "$1" in
+        --onto) onto=$2; shift ;;
+        *) branch=$1 ;;
+      esac
+      shift
+    done
+    git checkout -q "$onto" &&
+      git merge -q --squash "$branch" >/dev/null &&
+      git commit -q -m "Land $branch" &&
+      git push -q origin "$onto" &&
+      git branch -q -D "$branch"
+    ;;
+esac
+'''
+
+
+class SpawnCounter:
+    # Counts every subprocess started while active, keyed by program name
+
+    def __init__(self):
+        self.counts = {}
+        self._original = subprocess.Popen.__init__
+
+    def __enter__(self):
+        counter = self
+        original = self._original
+
+        def counting_init(popen, args, *rest, **kwargs):
+            program = args if isinstance(args, str) else args[0]
+            program = os.path.basename(str(program).split()[0])
+            counter.counts[program] = counter.counts.get(program, 0) + 1
+            original(popen, args, *rest, **kwargs)
+
+        subprocess.Popen.__init__ = counting_init
+        return self
+
+    def __exit__(self, *exc):
+        subprocess.Popen.__init__ = self._original
+
+
+def top(args):
+    return 'patch-{}'.format(args.patches)
+
+
+def warm_phab(repo):
+    repo.print_stack(show_phab=True)
+
+
+def add_remote(repo):
+    # a local bare remote for arc land to push to
+    remote = os.path.join(os.path.dirname(os.getcwd()), '{}.remote'.format(os.path.basename(os.getcwd())))
+    subprocess.check_call(['git', 'clone', '-q', '--bare', '.', remote])
+    subprocess.check_call(['git', 'remote', 'add', 'origin', remote])
+
+
+def add_upstream(repo):
+    # a remote that already has every patch, and a master that moved on since
+    add_remote(repo)
+    subprocess.check_call(['git', 'push', '-q', 'origin', '--all'])
+    subprocess.check_call(['git', 'fetch', '-q', 'origin'])
+    subprocess.check_call(['git', 'branch', '-q', '-u', 'origin/master', 'master'])
+    tip = subprocess.check_output(
+        ['git', 'commit-tree', 'master^{tree}', '-p', 'master', '-m', 'Upstream'], universal_newlines=True).strip()
+    subprocess.check_call(['git', 'push', '-q', 'origin', '{}:refs/heads/master'.format(tip)])
+
+
+def move_remote_patch(repo):
+    # someone else pushed to patch-1 since we last fetched it, so the lease fails
+    add_upstream(repo)
+    tracked = subprocess.check_output(['git', 'rev-parse', 'origin/patch-1'], universal_newlines=True).strip()
+    tip = subprocess.check_output(
+        ['git', 'commit-tree', 'patch-1^{tree}', '-p', 'patch-1', '-m', 'Elsewhere'], universal_newlines=True).strip()
+    subprocess.check_call(['git', 'push', '-q', 'origin', '{}:refs/heads/patch-1'.format(tip)])
+    # pushing moved our remote-tracking ref too, put it back
+    subprocess.check_call(['git', 'update-ref', 'refs/remotes/origin/patch-1', tracked])
+    with open(os.path.join('.git', 'remote-before'), 'w') as f:
+        json.dump(patch_refs(['git', 'ls-remote', 'origin']), f)
+
+
+def drop_revisions(repo):
+    # a rebased stack that was never uploaded, so every diff gets created
+    from gack.replay import reword
+    from gack.status import DIFF_REVISION_RE
+
+    repo.restack(all=True)
+    repo = GackRepo()
+    snapshot = repo._walk_stack()
+    messages = {}
+    for patch in snapshot.patches[1:]:
+        for commit in patch.commits:
+            messages[commit.sha] = re.sub(DIFF_REVISION_RE + r'\n?', '', commit.message)
+    repo._move_patches(reword(repo._git, snapshot, messages))
+
+
+def edit_every_patch(repo):
+    # a working tree change for each patch to absorb, on a stack with none to rebase
+    repo.restack(all=True)
+    for path in sorted(os.listdir('patches')):
+        with open(os.path.join('patches', path), 'w') as f:
+            f.write('{} absorbed\n'.format(path))
+
+
+def trees(revisions):
+    output = subprocess.check_output(['git', 'log', '--no-walk', '--format=%T'] + list(revisions), universal_newlines=True)
+    return sorted(output.split())
+
+
+def patch_refs(command):
+    # refs/heads/patch-* -> SHA, from "<sha>\t<refname>" lines
+    refs = {}
+    for line in subprocess.check_output(command, universal_newlines=True).splitlines():
+        sha, refname = line.split('\t')
+        if refname.startswith('refs/heads/patch-'):
+            refs[refname] = sha
+    return refs
+
+
+def local_patch_refs():
+    return patch_refs(['git', 'for-each-ref', '--format=%(objectname)\t%(refname)', 'refs/heads/patch-*'])
+
+
+def check_synced(repo, args):
+    # the remote holds exactly the restacked stack
+    if patch_refs(['git', 'ls-remote', 'origin']) != local_patch_refs():
+        return ['remote patch branches differ from the local ones']
+    return []
+
+
+def check_lease_rejected(repo, args):
+    # one stale lease keeps every branch from being pushed
+    with open(os.path.join('.git', 'remote-before')) as f:
+        before = json.load(f)
+    failures = []
+    if patch_refs(['git', 'ls-remote', 'origin']) != before:
+        failures.append('remote patch branches moved although a lease failed')
+    if local_patch_refs() == before:
+        failures.append('nothing was restacked, so nothing would have been pushed')
+    return failures
+
+
+def stack_state():
+    # the patch branches, every stack file and the active stack
+    stacks_dir = os.path.join('.git', 'gack', 'stacks')
+    stacks = {}
+    for name in os.listdir(stacks_dir):
+        with open(os.path.join(stacks_dir, name)) as f:
+            stacks[name] = f.read()
+    active = None
+    if os.path.exists(os.path.join('.git', 'gack', 'active')):
+        with open(os.path.join('.git', 'gack', 'active')) as f:
+            active = f.read()
+    return {'refs': local_patch_refs(), 'stacks': stacks, 'active': active}
+
+
+def reflog_messages(refnames):
+    # the latest reflog message of each ref
+    return set(subprocess.check_output(
+        ['git', 'reflog', 'show', '-n1', '--format=%gs', refname], universal_newlines=True).strip() for refname in refnames)
+
+
+def check_undo_redo(repo, args):
+    # undo puts back exactly what the warm-up changed, and redo redoes it,
+    # each moving branches with a reflog message of its own
+    before = saved_state('before')
+    after = saved_state('after')
+    moved = [refname for refname, sha in before['refs'].items() if after['refs'].get(refname) != sha]
+    failures = []
+    if stack_state() != before:
+        failures.append('undo did not restore the branches and stack files')
+    if reflog_messages(moved) - {'gack undo'}:
+        failures.append('undo left reflog messages {}'.format(sorted(reflog_messages(moved))))
+    GackRepo().redo()
+    if stack_state() != after:
+        failures.append('redo did not restore the branches and stack files')
+    if reflog_messages(moved) - {'gack redo'}:
+        failures.append('redo left reflog messages {}'.format(sorted(reflog_messages(moved))))
+    return failures
+
+
+def check_uploads(repo, args):
+    # every diff must hold its whole patch, not just the patch's tip commit
+    with open(os.path.join('.git', 'arc-diffs')) as f:
+        heads = [line.split()[0] for line in f]
+    uploaded = trees(heads)
+    expected = trees('patch-{}'.format(p) for p in range(1, args.patches + 1))
+    if uploaded != expected:
+        return ['uploaded trees differ from the patches\' trees']
+    return []
+
+
+def commit_lines(path, patches):
+    # each of patches, bottom first, adds a line of its own to path
+    branch = subprocess.check_output(['git', 'symbolic-ref', '--short', 'HEAD'], universal_newlines=True).strip()
+    lines = []
+    for patch in patches:
+        lines.append(patch)
+        subprocess.check_call(['git', 'checkout', '-q', patch])
+        with open(path, 'w') as f:
+            f.write(''.join(line + '\n' for line in lines))
+        subprocess.check_call(['git', 'add', path])
+        subprocess.check_call(['git', 'commit', '-q', '-m', 'Add {} to {}'.format(patch, path)])
+        GackRepo().restack(all=True)
+    subprocess.check_call(['git', 'checkout', '-q', branch])
+
+
+def edit_across_patches(repo):
+    # one hunk over lines of two patches and one over master's, which absorb
+    # must leave alone, and one it can absorb into patch-3
+    repo.restack(all=True)
+    commit_lines('shared.txt', ['patch-1', 'patch-2'])
+    edits = {
+        'shared.txt': 'patch-1 edited\npatch-2 edited\n',
+        os.path.join('src', 'file-000000.txt'): 'file 0 edited\n',
+        os.path.join('patches', 'patch-3.txt'): 'patch-3.txt absorbed\n',
+    }
+    for path, content in edits.items():
+        with open(path, 'w') as f:
+            f.write(content)
+
+
+def edit_next_to_patch(repo):
+    # a change to patch-1's line right above patch-2's, which conflicts when
+    # folded into patch-1
+    repo.restack(all=True)
+    commit_lines('adjacent.txt', ['patch-1', 'patch-2'])
+    with open('adjacent.txt', 'w') as f:
+        f.write('patch-1 edited\npatch-2\n')
+    with open(os.path.join('.git', 'refs-before'), 'w') as f:
+        json.dump(local_patch_refs(), f)
+
+
+def restack_first(repo):
+    # reordering replays the stack, so start from a restacked one
+    repo.restack(all=True)
+
+
+def swap_next_to_patch(repo):
+    # patch-2 edits the file patch-1 adds, so they conflict once swapped
+    repo.restack(all=True)
+    commit_lines('adjacent.txt', ['patch-1', 'patch-2'])
+    save_state('before')
+
+
+def save_state(name):
+    with open(os.path.join('.git', 'state-{}'.format(name)), 'w') as f:
+        json.dump(stack_state(), f)
+
+
+def saved_state(name):
+    with open(os.path.join('.git', 'state-{}'.format(name))) as f:
+        return json.load(f)
+
+
+def restack_to_undo(repo):
+    save_state('before')
+    repo.restack(all=True)
+    save_state('after')
+
+
+def delete_stack_to_undo(repo):
+    repo.new_stack('other', 'patch-2')
+    repo.switch_stack('default')
+    save_state('before')
+    repo.delete_stack('other')
+    save_state('after')
+
+
+def deinit_to_undo(repo):
+    save_state('before')
+    repo.deinitialize()
+    save_state('after')
+
+
+# name -> (branch to check out first, untimed warm-up, timed command)
+BENCHMARKS = {
+    'show': (top, None, lambda repo, args: repo.print_stack(show_phab=False)),
+    'show-phab-cold': (top, None, lambda repo, args: repo.print_stack(show_phab=True)),
+    'show-phab-warm': (top, warm_phab, lambda repo, args: repo.print_stack(show_phab=True)),
+    'show-json-warm': (top, warm_phab, lambda repo, args: repo.print_stack_json()),
+    'push-rebase': (lambda args: 'patch-1', None, lambda repo, args: repo.push_one(rebase=True)),
+    'pop-all': (top, None, lambda repo, args: repo.pop(all=True)),
+    'arcdiff': (lambda args: 'patch-2', None, lambda repo, args: repo.arc_diff(edit_diff=False)),
+    'arcdiff-all': (top, None, lambda repo, args: repo.arc_diff_all(message='benchmark')),
+    'arcdiff-all-new': (top, drop_revisions, lambda repo, args: repo.arc_diff_all(message='benchmark')),
+    'arcland-through': (top, add_remote, lambda repo, args: repo.arc_land_through('patch-{}'.format(args.patches // 2))),
+    'untrack': (top, None, lambda repo, args: repo.untrack(top(args))),
+    'restack-all': (top, None, lambda repo, args: repo.restack(all=True)),
+    'sync': (top, add_upstream, lambda repo, args: repo.sync()),
+    'sync-lease-rejected': (top, move_remote_patch, lambda repo, args: repo.sync()),
+    'absorb': (top, edit_every_patch, lambda repo, args: repo.absorb()),
+    'absorb-left-alone': (top, edit_across_patches, lambda repo, args: repo.absorb()),
+    'absorb-conflict': (top, edit_next_to_patch, lambda repo, args: repo.absorb()),
+    'check': (top, None, lambda repo, args: repo.check()),
+    'move': (top, restack_first, lambda repo, args: repo.move(top(args), 1)),
+    'swap': (top, restack_first, lambda repo, args: repo.swap(top(args))),
+    'swap-conflict': (top, swap_next_to_patch, lambda repo, args: repo.swap('patch-2')),
+    'undo-restack': (top, restack_to_undo, lambda repo, args: repo.undo()),
+    'undo-delete-stack': (top, delete_stack_to_undo, lambda repo, args: repo.undo()),
+    'undo-deinit': (top, deinit_to_undo, lambda repo, args: repo.undo()),
+}
+
+def show(revision, path):
+    # path's content at revision, None if it has no such file
+    result = subprocess.run(['git', 'show', '{}:{}'.format(revision, path)],
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    return result.stdout if result.returncode == 0 else None
+
+
+def changed_paths():
+    # paths whose working tree content differs from HEAD
+    return subprocess.check_output(['git', 'diff', '--name-only', 'HEAD'], universal_newlines=True).split()
+
+
+def check_absorbed(repo, args):
+    # each patch's file changed in that patch itself, nothing left behind
+    failures = []
+    for p in range(1, args.patches + 1):
+        path = 'patches/patch-{}.txt'.format(p)
+        if show('patch-{}'.format(p), path) != 'patch-{}.txt absorbed\n'.format(p):
+            failures.append('{} was not absorbed into patch-{}'.format(path, p))
+    if len(changed_paths()) > 0:
+        failures.append('left in the working tree: {}'.format(' '.join(changed_paths())))
+    return failures
+
+
+def check_left_alone(repo, args):
+    failures = []
+    if show('patch-3', 'patches/patch-3.txt') != 'patch-3.txt absorbed\n':
+        failures.append('patches/patch-3.txt was not absorbed into patch-3')
+    if show('patch-2', 'shared.txt') != 'patch-1\npatch-2\n':
+        failures.append('the hunk over two patches was absorbed')
+    if show('master', 'src/file-000000.txt') != show('patch-1', 'src/file-000000.txt'):
+        failures.append('the hunk over master\'s lines was absorbed')
+    if changed_paths() != ['shared.txt', 'src/file-000000.txt']:
+        failures.append('left in the working tree: {}'.format(' '.join(changed_paths())))
+    return failures
+
+
+def check_nothing_absorbed(repo, args):
+    with open(os.path.join('.git', 'refs-before')) as f:
+        before = json.load(f)
+    failures = []
+    if local_patch_refs() != before:
+        failures.append('patch branches moved although absorbing conflicted')
+    if changed_paths() != ['adjacent.txt']:
+        failures.append('left in the working tree: {}'.format(' '.join(changed_paths())))
+    return failures
+
+
+def check_nothing_swapped(repo, args):
+    if stack_state() != saved_state('before'):
+        return ['the branches or stack files changed although swapping conflicted']
+    return []
+
+
+# name -> check run after the timed command; returns what went wrong
+CHECKS = {
+    'sync': check_synced,
+    'sync-lease-rejected': check_lease_rejected,
+    'absorb': check_absorbed,
+    'absorb-left-alone': check_left_alone,
+    'absorb-conflict': check_nothing_absorbed,
+    'swap-conflict': check_nothing_swapped,
+    'undo-restack': check_undo_redo,
+    'undo-delete-stack': check_undo_redo,
+    'undo-deinit': check_undo_redo,
+    'arcdiff-all-new': check_uploads,
+}
+
+
+def run_benchmark(template, work_dir, name, args):
+    branch, warm_up, command = BENCHMARKS[name]
+    path = os.path.join(work_dir, name)
+    shutil.copytree(template, path, symlinks=True)
+    subprocess.check_call(['git', 'checkout', '-q', branch(args)], cwd=path)
+
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            repo = GackRepo()
+            if warm_up is not None:
+                warm_up(repo)
+                repo = GackRepo()
+            with SpawnCounter() as counter:
+                start = time.perf_counter()
+                command(repo, args)
+                elapsed = time.perf_counter() - start
+            failures = CHECKS[name](repo, args) if name in CHECKS else []
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(path)
+        shutil.rmtree('{}.remote'.format(path), ignore_errors=True)
+    return elapsed, counter.counts, failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark gack commands')
+    add_arguments(parser)
+    parser.add_argument('--runs', type=int, default=3, help='Runs per command; the median is reported')
+    parser.add_argument('--only', nargs='*', choices=sorted(BENCHMARKS), help='Only run these benchmarks')
+    parser.add_argument('--json', help='Write results to this file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        stub_dir = os.path.join(work_dir, 'bin')
+        os.mkdir(stub_dir)
+        with open(os.path.join(stub_dir, 'arc'), 'w') as f:
+            f.write(STUB_ARC)
+        os.chmod(os.path.join(stub_dir, 'arc'), 0o755)
+        os.environ['PATH'] = stub_dir + os.pathsep + os.environ['PATH']
+
+        template = os.path.join(work_dir, 'template')
+        start = time.perf_counter()
+        make_stacked_repo(template, **repo_options(args))
+        print('generated repo in {:.1f}s'.format(time.perf_counter() - start))
+
+        results = {}
+        failed = False
+        for name in args.only or BENCHMARKS:
+            timings = []
+            for _ in range(args.runs):
+                elapsed, counts, failures = run_benchmark(template, work_dir, name, args)
+                timings.append(elapsed)
+                for failure in failures:
+                    failed = True
+                    print('FAILED {}: {}'.format(name, failure))
+            results[name] = {
+                'seconds': round(statistics.median(timings), 4),
+                'git_spawns': counts.get('git', 0),
+                'other_spawns': sum(n for program, n in counts.items() if program != 'git'),
+            }
+            print('{:<16} {:>9.1f}ms {:>5} git spawns'.format(
+                name, results[name]['seconds'] * 1000, results[name]['git_spawns']))
+
+    output = {
+        'repo': repo_options(args),
+        'git_version': subprocess.check_output(['git', 'version'], universal_newlines=True).strip(),
+        'results': results,
+    }
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
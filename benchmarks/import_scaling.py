@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+'''
+Times `gack import` of an exported stack as the stack grows, to check that
+import time grows linearly with the total number of commits.
+
+For every --sizes entry a synthetic stack (see synthetic.py) with that many
+commits spread over --patches patches is exported with `gack export`, then
+imported into a fresh repo holding only master. Every imported patch must
+come back with the exact SHA it was exported with.
+
+    python3 benchmarks/import_scaling.py [--sizes 250 500 1000 2000] [--patches 10] [--runs 3] [--max-growth 2]
+
+Exits non-zero if any patch does not round-trip exactly, or if the import
+time per commit at any size is more than --max-growth times what it is at
+the smallest size. Fixed costs only make the smallest stack dearer per
+commit, so a linear import stays well within the bound, while one that is
+quadratic in the commit count grows with the ratio of the sizes.
+'''
+
+import argparse
+import contextlib
+import io
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from gack import GackRepo
+from synthetic import make_stacked_repo
+
+
+def branch_shas(path):
+    output = subprocess.check_output(
+        ['git', 'for-each-ref', '--format=%(refname:short) %(objectname)', 'refs/heads/patch-*'],
+        cwd=path, universal_newlines=True)
+    return dict(line.split() for line in output.splitlines())
+
+
+def run_in(path, command):
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            command(GackRepo())
+            return time.perf_counter() - start
+    finally:
+        os.chdir(cwd)
+
+
+def time_import(work_dir, source, series, runs):
+    timings = []
+    # the first run also pays for loading gack and is not counted
+    for run in range(runs + 1):
+        path = os.path.join(work_dir, 'import-{}'.format(run))
+        # master is fetched in, so something else has to be checked out
+        subprocess.check_call(['git', 'init', '-q', '-b', 'import', path])
+        subprocess.check_call(['git', 'fetch', '-q', source, 'master:master'], cwd=path)
+        timings.append(run_in(path, lambda repo: repo.import_stack(series)))
+        if branch_shas(path) != branch_shas(source):
+            return None
+    return statistics.median(timings[1:])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that gack import scales linearly with commit count')
+    parser.add_argument('--sizes', type=int, nargs='*', default=[250, 500, 1000, 2000], help='Total commits in the stack')
+    parser.add_argument('--patches', type=int, default=10, help='Patches in the stack')
+    parser.add_argument('--runs', type=int, default=3, help='Timed runs per size; the median is reported')
+    parser.add_argument('--max-growth', type=float, default=2.0,
+                        help='Largest allowed ratio of the time per commit to that of the smallest size')
+    args = parser.parse_args()
+
+    failed = False
+    # (commits, import seconds)
+    points = []
+    for size in args.sizes:
+        commits = max(size // args.patches, 1)
+        with tempfile.TemporaryDirectory() as work_dir:
+            source = os.path.join(work_dir, 'source')
+            make_stacked_repo(source, patches=args.patches, commits=commits, branches=args.patches + 1,
+                              history=10, files=100, diverge=False)
+            series = os.path.join(work_dir, 'series')
+            export_seconds = run_in(source, lambda repo: repo.export_stack(series))
+            import_seconds = time_import(work_dir, source, series, args.runs)
+
+        total = commits * args.patches
+        if import_seconds is None:
+            failed = True
+            print('{:>6} commits  MISMATCH: imported patches differ from the exported ones'.format(total))
+            continue
+        marginal = ''
+        if len(points) > 0:
+            # constant when import time is linear; fixed costs (and small
+            # packs that git unpacks into loose objects) only show in the total
+            commits_before, seconds_before = points[-1]
+            marginal = '  {:.3f}ms per added commit'.format(
+                (import_seconds - seconds_before) * 1000 / (total - commits_before))
+        points.append((total, import_seconds))
+        print('{:>6} commits  export {:>8.1f}ms  import {:>8.1f}ms{}'.format(
+            total, export_seconds * 1000, import_seconds * 1000, marginal))
+        smallest_commits, smallest_seconds = points[0]
+        growth = (import_seconds / total) / (smallest_seconds / smallest_commits)
+        if growth > args.max_growth:
+            failed = True
+            print('{:>6} commits  NOT LINEAR: {:.1f}x the time per commit of {} commits'.format(
+                total, growth, smallest_commits))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
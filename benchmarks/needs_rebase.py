@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+'''
+Checks gack's needs-rebase detection against git on synthetic diverged
+stacks, and times it.
+
+Builds a stacked repo (see synthetic.py), then adds commits to master and to
+every --every'th patch so the patches above them fall behind. gack's ahead
+and behind counts for every patch, all from one batched history walk, are
+compared with `git rev-list --left-right --count --first-parent` run per
+pair, which is also timed as the per-patch baseline.
+
+    python3 benchmarks/needs_rebase.py [--every 3] [--runs 5] [synthetic.py options]
+
+Exits non-zero if any count differs from git's.
+'''
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from gack.plumbing import Git
+from gack.refs import RefStore, find_git_dir
+from gack.stackfile import Stacks
+from gack.status import StackSnapshot
+from synthetic import add_arguments, make_stacked_repo, repo_options
+
+
+def diverge(git, branch, commits):
+    # Adds empty commits on top of branch without touching the working tree
+    tip = git.run('rev-parse', branch).strip()
+    for n in range(commits):
+        tip = git.run('commit-tree', '{}^{{tree}}'.format(tip), '-p', tip, input='Diverge {} {}\n'.format(branch, n)).strip()
+    git.run('update-ref', 'refs/heads/{}'.format(branch), tip)
+
+
+def snapshot(path):
+    git_dir, common_dir = find_git_dir(path)
+    entries = Stacks(os.path.join(common_dir, 'gack')).file().read()
+    bases = dict((entry.name, entry.base) for entry in entries)
+    return StackSnapshot(Git(path), RefStore(git_dir, common_dir), [entry.name for entry in entries], None, bases)
+
+
+def git_counts(git, patches):
+    counts = []
+    for parent, patch in zip(patches, patches[1:]):
+        behind, ahead = git.run(
+            'rev-list', '--left-right', '--count', '--first-parent',
+            '{}...{}'.format(parent.sha, patch.sha)).split()
+        counts.append((int(ahead), int(behind)))
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check and time needs-rebase detection')
+    add_arguments(parser)
+    parser.add_argument('--every', type=int, default=3, help='Diverge every n-th patch')
+    parser.add_argument('--runs', type=int, default=5, help='Timed runs; the median is reported')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as path:
+        make_stacked_repo(path, **repo_options(args))
+        git = Git(path)
+        diverge(git, 'master', 2)
+        for p in range(1, args.patches + 1, args.every):
+            diverge(git, 'patch-{}'.format(p), 1)
+
+        batched = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            result = snapshot(path)
+            batched.append(time.perf_counter() - start)
+
+        per_pair = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            expected = git_counts(git, result.patches)
+            per_pair.append(time.perf_counter() - start)
+
+    mismatches = 0
+    for patch, (ahead, behind) in zip(result.patches[1:], expected):
+        if (patch.ahead, patch.behind) != (ahead, behind):
+            mismatches += 1
+            print('MISMATCH {}: gack ahead {} behind {}, git ahead {} behind {}'.format(
+                patch.name, patch.ahead, patch.behind, ahead, behind))
+
+    print('{} patches, {} need rebase'.format(
+        len(result.patches) - 1, sum(1 for patch in result.patches if patch.needs_rebase)))
+    print('batched walk: {:.1f}ms  per-pair rev-list: {:.1f}ms'.format(
+        statistics.median(batched) * 1000, statistics.median(per_pair) * 1000))
+    if mismatches > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
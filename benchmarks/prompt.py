@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+'''
+Startup benchmark for `gack prompt`.
+
+Builds a throwaway gack repo, then times `python -m gack prompt` end to end and
+subtracts the cost of `python -m` on an empty module, which gack cannot
+influence.
+Exits non-zero if the prompt is over budget, imports GitPython or spawns a
+subprocess.
+
+    python3 benchmarks/prompt.py [--runs N] [--budget-ms MS]
+'''
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs the prompt in-process and reports which heavy modules it pulled in
+PROBE = '''
+import sys
+from gack.prompt import main
+main([])
+print('LOADED', ' '.join(m for m in ('git', 'subprocess', 'argparse') if m in sys.modules))
+'''
+
+
+def make_repo(path, branches):
+    def git(*args):
+        subprocess.check_call(['git'] + list(args), cwd=path, stdout=subprocess.DEVNULL)
+    git('init', '-q', '-b', 'master')
+    git('-c', 'user.name=bench', '-c', 'user.email=bench@localhost', 'commit', '-q', '--allow-empty', '-m', 'root')
+    for i in range(branches):
+        git('branch', 'branch-{}'.format(i))
+    git('pack-refs', '--all')
+    git('checkout', '-q', '-b', 'patch')
+    os.makedirs(os.path.join(path, '.git', 'gack', 'stacks'))
+    with open(os.path.join(path, '.git', 'gack', 'stacks', 'default'), 'w') as f:
+        f.write('master\npatch\n')
+    with open(os.path.join(path, 'empty_module.py'), 'w') as f:
+        f.write('')
+
+
+def time_command(command, cwd, env, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.check_call(command, cwd=cwd, env=env, stdout=subprocess.DEVNULL)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark gack prompt startup')
+    parser.add_argument('--runs', type=int, default=30)
+    parser.add_argument('--budget-ms', type=float, default=10.0, help='Budget on top of bare interpreter startup')
+    parser.add_argument('--branches', type=int, default=1000)
+    args = parser.parse_args()
+
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    with tempfile.TemporaryDirectory() as path:
+        make_repo(path, args.branches)
+
+        loaded = subprocess.check_output([sys.executable, '-c', PROBE], cwd=path, env=env, universal_newlines=True)
+        print(loaded.strip())
+        heavy = loaded.strip().split('LOADED')[-1].split()
+
+        baseline = time_command([sys.executable, '-m', 'empty_module'], path, env, args.runs)
+        prompt = time_command([sys.executable, '-m', 'gack', 'prompt'], path, env, args.runs)
+
+    overhead = prompt - baseline
+    print('interpreter: {:.1f}ms  gack prompt: {:.1f}ms  overhead: {:.1f}ms (budget {:.1f}ms)'.format(
+        baseline, prompt, overhead, args.budget_ms))
+
+    if heavy:
+        print('FAIL: gack prompt imported {}'.format(', '.join(heavy)))
+        sys.exit(1)
+    if overhead > args.budget_ms:
+        print('FAIL: gack prompt is over budget')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+'''
+Cold-start regression check for every gack command.
+
+Runs each command under `python -X importtime` in a throwaway gack repo and
+reports how long its imports took (best of --runs) and which heavy modules it
+loaded.
+Commands that have no business loading GitPython (or spawning git at all)
+fail the run if they do. With --baseline, import time is also compared with
+an earlier --json result.
+
+    python3 benchmarks/startup.py [--runs 5] [--json OUT] [--baseline PREVIOUS] [--tolerance 2.0]
+'''
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY = ['git', 'subprocess', 'argparse']
+
+# (name, argv, modules the command must not import)
+COMMANDS = [
+    ('prompt', ['prompt'], ['git', 'subprocess', 'argparse']),
+    ('help', ['--help'], ['git', 'subprocess']),
+    ('unknown', ['no-such-command'], ['git', 'subprocess']),
+    ('bad-args', ['push', '--no-such-flag'], ['git', 'subprocess']),
+    ('init', ['init', 'master'], ['git', 'subprocess']),
+    ('show', ['show'], ['git', 'subprocess']),
+    ('show-phab', ['show', '--phab'], ['git']),
+    ('pop-at-bottom', ['pop'], ['git', 'subprocess']),
+    ('edit-help', ['edit', '--help'], ['git', 'subprocess']),
+    ('check', ['check'], ['git']),
+]
+
+
+def make_repo(path):
+    def git(*args):
+        subprocess.check_call(['git'] + list(args), cwd=path, stdout=subprocess.DEVNULL)
+    git('init', '-q', '-b', 'master')
+    git('-c', 'user.name=bench', '-c', 'user.email=bench@localhost', 'commit', '-q', '--allow-empty', '-m', 'root')
+    git('branch', 'patch')
+
+
+def import_times(stderr):
+    # Sum the cumulative time of top-level imports; nested ones are included
+    total_us = 0
+    loaded = set()
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        loaded.add(name.strip())
+        if not name.startswith('  '):
+            total_us += int(cumulative)
+    return total_us / 1000, loaded
+
+
+def run(path, env, argv):
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-m', 'gack'] + argv,
+        cwd=path, env=env, stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    wall_ms = (time.perf_counter() - start) * 1000
+    import_ms, loaded = import_times(result.stderr)
+    return wall_ms, import_ms, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check per-command gack startup')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--json', help='Write results to this file')
+    parser.add_argument('--baseline', help='Earlier --json output to compare import times against')
+    parser.add_argument('--tolerance', type=float, default=2.0, help='Allowed import time ratio over the baseline')
+    args = parser.parse_args()
+
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    results = {}
+    failures = []
+    with tempfile.TemporaryDirectory() as path:
+        make_repo(path)
+        for name, argv, forbidden in COMMANDS:
+            if name == 'show':
+                # everything after init runs against an initialized, two-patch stack
+                with open(os.path.join(path, '.git', 'gack', 'stacks', 'default'), 'a') as f:
+                    f.write('patch\n')
+            wall_ms, import_ms, loaded = run(path, env, argv)
+            for _ in range(args.runs - 1):
+                # init is only a cold start the first time round
+                if name == 'init':
+                    break
+                again = run(path, env, argv)
+                wall_ms, import_ms = min(wall_ms, again[0]), min(import_ms, again[1])
+            results[name] = {
+                'argv': argv,
+                'wall_ms': round(wall_ms, 2),
+                'import_ms': round(import_ms, 2),
+                'heavy_modules': sorted(m for m in HEAVY if m in loaded),
+            }
+            for module in forbidden:
+                if module in loaded:
+                    failures.append('{} imported {}'.format(name, module))
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    print('{:<16} {:>9} {:>10}  {}'.format('command', 'wall ms', 'import ms', 'heavy modules'))
+    for name, result in results.items():
+        print('{:<16} {:>9.1f} {:>10.1f}  {}'.format(
+            name, result['wall_ms'], result['import_ms'], ' '.join(result['heavy_modules'])))
+        previous = baseline.get(name)
+        if previous and result['import_ms'] > previous['import_ms'] * args.tolerance:
+            failures.append('{} import time regressed: {:.1f}ms -> {:.1f}ms'.format(
+                name, previous['import_ms'], result['import_ms']))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    for failure in failures:
+        print('FAIL: {}'.format(failure))
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+'''
+Synthetic stacked-repo generator for the gack benchmarks.
+
+Writes the whole history with a single `git fast-import` stream, so even large
+repos are quick to build:
+
+    master: <history> commits; the first one adds <files> files
+    patch-1 .. patch-<patches>: a linear stack of <commits> commits each on top
+        of master, every patch carrying a Differential Revision line
+    extra-*: more branches pointing into master's history, up to <branches>
+        branches in total
+
+With diverge, patch-1 gets one more commit after the stack was built, so
+every patch above it needs a rebase. The default gack stack is written with
+the base and tip of every patch recorded.
+
+    python3 benchmarks/synthetic.py PATH [--patches 10] [--commits 3] ...
+'''
+
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from gack.stackfile import StackEntry, StackFile
+
+AUTHOR = 'Bench <bench@localhost>'
+
+
+class Stream:
+
+    def __init__(self):
+        self.chunks = []
+        self.marks = 0
+        self.time = 1500000000
+
+    def blob(self, content):
+        data = content.encode()
+        self.chunks.append(b'blob\ndata %d\n%s\n' % (len(data), data))
+
+    def commit(self, branch, message, files, parent_mark=None):
+        self.marks += 1
+        self.time += 60
+        mark = self.marks
+        data = message.encode()
+        lines = [
+            'commit refs/heads/{}'.format(branch),
+            'mark :{}'.format(mark),
+            'author {} {} +0000'.format(AUTHOR, self.time),
+            'committer {} {} +0000'.format(AUTHOR, self.time),
+        ]
+        self.chunks.append('\n'.join(lines).encode() + b'\ndata %d\n%s\n' % (len(data), data))
+        if parent_mark is not None:
+            self.chunks.append('from :{}\n'.format(parent_mark).encode())
+        for path, content in files.items():
+            body = content.encode()
+            self.chunks.append(b'M 100644 inline %s\ndata %d\n%s\n' % (path.encode(), len(body), body))
+        self.chunks.append(b'\n')
+        return mark
+
+    def reset(self, branch, mark):
+        self.chunks.append('reset refs/heads/{}\nfrom :{}\n\n'.format(branch, mark).encode())
+
+    def bytes(self):
+        return b''.join(self.chunks)
+
+
+def git(path, *args, **kwargs):
+    return subprocess.run(['git'] + list(args), cwd=path, check=True, stdout=subprocess.PIPE, **kwargs).stdout
+
+
+def make_stacked_repo(path, patches=10, commits=3, branches=100, history=100, files=1000, diverge=True):
+    path = os.path.abspath(path)
+    os.makedirs(path, exist_ok=True)
+    git(path, 'init', '-q', '-b', 'master')
+    git(path, 'config', 'user.name', 'Bench')
+    git(path, 'config', 'user.email', 'bench@localhost')
+
+    stream = Stream()
+    tree = dict(('src/file-{:06d}.txt'.format(i), 'file {}\n'.format(i)) for i in range(files))
+    history_marks = [stream.commit('master', 'Initial import\n', tree)]
+    for i in range(1, history):
+        history_marks.append(stream.commit(
+            'master', 'History {}\n'.format(i),
+            {'src/file-{:06d}.txt'.format(i % max(files, 1)): 'file {} rev {}\n'.format(i % max(files, 1), i)},
+            history_marks[-1]))
+
+    patch_marks = []
+    parent = history_marks[-1]
+    for p in range(1, patches + 1):
+        mark = parent
+        for c in range(1, commits + 1):
+            message = 'Patch {} commit {}\n'.format(p, c)
+            if c == commits:
+                message += '\nDifferential Revision: https://phab.example.com/D{}\n'.format(1000 + p)
+            mark = stream.commit(
+                'patch-{}'.format(p), message,
+                {'patches/patch-{}.txt'.format(p): 'patch {} commit {}\n'.format(p, c)},
+                mark)
+        patch_marks.append((parent, mark))
+        parent = mark
+
+    extra = max(branches - patches - 1, 0)
+    for i in range(extra):
+        stream.reset('extra-{}'.format(i), history_marks[i % len(history_marks)])
+
+    if diverge and patches > 0:
+        stream.commit('patch-1', 'Patch 1 follow-up\n', {'patches/patch-1.txt': 'patch 1 follow-up\n'}, patch_marks[0][1])
+
+    marks_path = os.path.join(path, '.git', 'bench-marks')
+    git(path, 'fast-import', '--quiet', '--export-marks={}'.format(marks_path), input=stream.bytes())
+    marks = {}
+    with open(marks_path) as f:
+        for line in f:
+            mark, sha = line.split()
+            marks[int(mark[1:])] = sha
+    os.remove(marks_path)
+
+    git(path, 'pack-refs', '--all')
+    git(path, 'checkout', '-q', 'master')
+
+    os.makedirs(os.path.join(path, '.git', 'gack', 'stacks'), exist_ok=True)
+    entries = [StackEntry('master')]
+    for p, (base, tip) in enumerate(patch_marks, 1):
+        entries.append(StackEntry('patch-{}'.format(p), marks[base], marks[tip]))
+    StackFile(os.path.join(path, '.git', 'gack', 'stacks', 'default')).write(entries)
+
+
+def add_arguments(parser):
+    parser.add_argument('--patches', type=int, default=10, help='Patches in the stack')
+    parser.add_argument('--commits', type=int, default=3, help='Commits per patch')
+    parser.add_argument('--branches', type=int, default=100, help='Total branch count')
+    parser.add_argument('--history', type=int, default=100, help='Commits on master')
+    parser.add_argument('--files', type=int, default=1000, help='Files in the working tree')
+    parser.add_argument('--no-diverge', dest='diverge', action='store_false',
+                        help='Leave the stack fully rebased')
+
+
+def repo_options(args):
+    return dict(
+        patches=args.patches,
+        commits=args.commits,
+        branches=args.branches,
+        history=args.history,
+        files=args.files,
+        diverge=args.diverge)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic gack repo')
+    parser.add_argument('path')
+    add_arguments(parser)
+    args = parser.parse_args()
+    make_stacked_repo(args.path, **repo_options(args))
+
+
+if __name__ == '__main__':
+    main()
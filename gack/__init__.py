@@ -1 +1,7 @@
-from .repo import GackRepo
+def __getattr__(name):
+    # GackRepo pulls in GitPython; only pay for it when it is actually used,
+    # so lightweight entry points like `gack prompt` stay fast
+    if name == 'GackRepo':
+        from .repo import GackRepo
+        return GackRepo
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
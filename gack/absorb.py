@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+from collections import namedtuple
+import os
+import re
+
+HUNK_HEADER_RE = r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@'
+
+# One `-U0` hunk; lines holds its body, without the @@ header
+Hunk = namedtuple('Hunk', ['old_start', 'old_count', 'new_start', 'new_count', 'lines'])
+
+
+class FileDiff:
+
+    def __init__(self, header):
+        # every line before the first hunk: diff --git, index, ---, +++, ...
+        self.header = header
+        self.path = None
+        self.hunks = []
+
+
+def parse_diff(text):
+    # Splits `git diff -U0` output into FileDiffs. Files without hunks
+    # (binary files, mode changes) come back with none
+    files = []
+    current = None
+    for line in text.split('\n'):
+        if line.startswith('diff --git '):
+            current = FileDiff([line])
+            files.append(current)
+        elif current is None:
+            continue
+        elif line.startswith('@@'):
+            matches = re.match(HUNK_HEADER_RE, line)
+            old_count = matches.group(2)
+            new_count = matches.group(4)
+            current.hunks.append(Hunk(
+                int(matches.group(1)), 1 if old_count is None else int(old_count),
+                int(matches.group(3)), 1 if new_count is None else int(new_count), []))
+        elif len(current.hunks) > 0:
+            if line:
+                current.hunks[-1].lines.append(line)
+        else:
+            current.header.append(line)
+            if line.startswith('+++ b/'):
+                current.path = line[len('+++ b/'):]
+            elif line.startswith('--- a/') and current.path is None:
+                # a deleted file has no new side
+                current.path = line[len('--- a/'):]
+    return files
+
+
+def file_lengths(git, tip, paths):
+    # Returns path -> number of lines in the file at tip, from one `git grep`
+    lengths = dict((path, 0) for path in paths)
+    if len(paths) == 0:
+        return lengths
+    # exits with 1 when every file is empty
+    _, output = git.run_with_status('grep', '-c', '', tip, '--', *paths, check=False)
+    for line in output.split('\n'):
+        # "<tip>:<path>:<count>"
+        name, _, count = line[len(tip) + 1:].rpartition(':')
+        if name in lengths:
+            lengths[name] = int(count)
+    return lengths
+
+
+def line_owners(git, tip, exclude, lengths):
+    # Returns path -> the commit that last touched each line of the file at
+    # tip, None for lines older than exclude, for every path in lengths. One
+    # `git log -p` replayed oldest first stands in for a blame per file.
+    owners = dict((path, []) for path in lengths)
+    if len(lengths) == 0:
+        return owners
+    args = ['log', '--first-parent', '--reverse', '-p', '-U0', '--no-renames', '--no-color',
+            '--format=%x00%H', tip]
+    if exclude is not None:
+        args.append('^' + exclude)
+    args.append('--')
+    args.extend(sorted(lengths))
+    for record in git.records(*args):
+        sha, _, diff = record.partition('\n')
+        for file_diff in parse_diff(diff):
+            if file_diff.path not in owners:
+                continue
+            lines = owners[file_diff.path]
+            # bottom hunk first, so the old line numbers of the others still hold
+            for hunk in reversed(file_diff.hunks):
+                start = hunk.old_start - 1 if hunk.old_count > 0 else hunk.old_start
+                if len(lines) < start + hunk.old_count:
+                    lines.extend([None] * (start + hunk.old_count - len(lines)))
+                lines[start:start + hunk.old_count] = [sha] * hunk.new_count
+    for path, lines in owners.items():
+        lines.extend([None] * (lengths[path] - len(lines)))
+    return owners
+
+
+def hunk_owners(hunk, lines):
+    # The commits owning the lines a hunk changes; a pure insertion belongs
+    # to the lines on either side of it
+    if hunk.old_count > 0:
+        start, end = hunk.old_start - 1, hunk.old_start - 1 + hunk.old_count
+    else:
+        start, end = max(hunk.old_start - 1, 0), hunk.old_start + 1
+    return set(lines[i] for i in range(start, min(end, len(lines))))
+
+
+def assign_hunks(file_diffs, owners, patch_of):
+    # patch_of maps a commit to its patch's index. Returns (index ->
+    # [(FileDiff, [Hunk])], hunks left unassigned); a hunk is only assigned
+    # when every line it touches comes from the same patch
+    assigned = {}
+    left = 0
+    for file_diff in file_diffs:
+        if file_diff.path is None or file_diff.path not in owners:
+            left += len(file_diff.hunks)
+            continue
+        by_patch = {}
+        for hunk in file_diff.hunks:
+            patches = set(patch_of.get(sha) for sha in hunk_owners(hunk, owners[file_diff.path]))
+            # nothing around it at all, or lines from more than one patch
+            if len(patches) != 1 or None in patches:
+                left += 1
+                continue
+            by_patch.setdefault(patches.pop(), []).append(hunk)
+        for index, hunks in by_patch.items():
+            assigned.setdefault(index, []).append((file_diff, hunks))
+    return assigned, left
+
+
+def format_patch(file_hunks):
+    # A patch holding only the given hunks of each file, renumbered so that
+    # `git apply --unidiff-zero` puts pure insertions where they belong
+    lines = []
+    for file_diff, hunks in file_hunks:
+        lines.extend(file_diff.header)
+        offset = 0
+        for hunk in hunks:
+            new_start = hunk.old_start + offset
+            if hunk.old_count == 0:
+                new_start += 1
+            if hunk.new_count == 0:
+                new_start -= 1
+            lines.append('@@ -{},{} +{},{} @@'.format(hunk.old_start, hunk.old_count, new_start, hunk.new_count))
+            lines.extend(hunk.lines)
+            offset += hunk.new_count - hunk.old_count
+    return '\n'.join(lines) + '\n'
+
+
+def fixup_tree(git, git_dir, head, patch):
+    # The tree of head with patch applied, built in a scratch index so the
+    # real index and the working tree are never touched
+    env = {'GIT_INDEX_FILE': os.path.join(git_dir, 'gack-absorb.index')}
+    try:
+        git.run('read-tree', head, env=env)
+        git.run('apply', '--cached', '--unidiff-zero', '-', input=patch, env=env)
+        return git.run('write-tree', env=env).strip()
+    finally:
+        if os.path.exists(env['GIT_INDEX_FILE']):
+            os.remove(env['GIT_INDEX_FILE'])
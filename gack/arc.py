@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+import re
+import threading
+import time
+
+from . import trace
+from .replay import Replayer
+from .status import DEPENDS_ON_RE
+
+REVISION_URI_RE = r'Revision URI:\s+([a-z]+://[^\s]+/(D[0-9]+))'
+DEPENDS_ON_LINE_RE = r'^[ \t]*Depends on D[0-9]+[ \t]*(\n|$)'
+
+# Concurrent `arc diff` processes when no --jobs is given
+DEFAULT_JOBS = 4
+
+
+def with_trailers(message, trailers):
+    # Appends trailer lines as a final paragraph of a commit message
+    return '{}\n\n{}\n'.format(message.rstrip('\n'), '\n'.join(trailers))
+
+
+def depends_on_messages(snapshot, start=1, end=None):
+    # Returns sha -> new message for every commit of patches [start, end) that
+    # needs its `Depends on` line added, pointed at the parent's current
+    # revision, or dropped because the patch now sits on the stack root
+    messages = {}
+    for i in range(start, end or len(snapshot.patches)):
+        patch = snapshot.patches[i]
+        if patch.sha is None or len(patch.commits) == 0:
+            continue
+        wanted = snapshot.patches[i - 1].revision if i > 1 else None
+        if i > 1 and wanted is None:
+            # the parent has not been uploaded, there is nothing to point at
+            continue
+
+        found = False
+        for commit in patch.commits:
+            if re.search(DEPENDS_ON_RE, commit.message) is None:
+                continue
+            found = True
+            if wanted is not None:
+                message = re.sub(DEPENDS_ON_RE, 'Depends on {}'.format(wanted), commit.message)
+            else:
+                message = re.sub(DEPENDS_ON_LINE_RE, '', commit.message, flags=re.MULTILINE).rstrip('\n') + '\n'
+            if message != commit.message:
+                messages[commit.sha] = message
+        if not found and wanted is not None:
+            messages[patch.sha] = with_trailers(patch.commits[0].message, ['Depends on {}'.format(wanted)])
+    return messages
+
+
+class Upload:
+
+    def __init__(self, index, patch):
+        self.index = index
+        self.patch = patch
+        self.command = None
+        self.output = ''
+        self.returncode = None
+        self.skipped = None
+        self.revision_url = patch.revision_url
+        self.revision = patch.revision
+        # revision a newly created diff was told it depends on
+        self.depends_on = None
+        self.done = threading.Event()
+
+    @property
+    def created(self):
+        return self.patch.revision is None and self.revision is not None
+
+    @property
+    def failed(self):
+        return self.returncode not in (None, 0)
+
+
+'''
+Uploads every patch of a snapshot with its own `arc diff` process, several
+at a time. arc only ever sees commit objects (`arc diff --head <sha> <base>`),
+so nothing is checked out and the working tree stays as it is.
+
+A patch without a revision waits for its parent's upload: once the parent's
+revision is known the new diff is created with a `Depends on` line, which
+arc reads from a throwaway commit carrying it, the whole patch squashed onto
+its base. Writing the new trailers into the branches is left to the caller.
+'''
+class UploadPipeline:
+
+    def __init__(self, git, work_dir, snapshot, message, jobs=None):
+        self._git = git
+        self._work_dir = work_dir
+        self._message = message
+        self._slots = threading.Semaphore(jobs or DEFAULT_JOBS)
+        self.uploads = [Upload(i, snapshot.patches[i]) for i in range(1, len(snapshot.patches))]
+
+    def run(self):
+        # Yields every Upload in stack order as soon as it and all uploads
+        # below it have finished
+        threads = [threading.Thread(target=self._upload, args=(upload,)) for upload in self.uploads]
+        for thread in threads:
+            thread.start()
+        for upload in self.uploads:
+            upload.done.wait()
+            yield upload
+        for thread in threads:
+            thread.join()
+
+    def _upload(self, upload):
+        try:
+            patch = upload.patch
+            if patch.sha is None:
+                upload.skipped = 'branch not found'
+                return
+            elif patch.commit_count == 0:
+                upload.skipped = 'no commits'
+                return
+            elif patch.needs_rebase and upload.index > 1:
+                # the first patch is diffed against its own base even when
+                # the root has moved on
+                upload.skipped = 'needs rebase, run `gack restack` first'
+                return
+
+            head = patch.sha
+            if upload.revision is None and upload.index > 1 and patch.depends_on is None:
+                parent = self.uploads[upload.index - 2]
+                parent.done.wait()
+                if parent.revision is not None:
+                    upload.depends_on = parent.revision
+                    message = with_trailers(patch.commits[0].message, ['Depends on {}'.format(parent.revision)])
+                    # the whole patch as one commit, so arc sees every change in it
+                    head = Replayer(self._git).squash(patch.sha, patch.base, message)
+
+            command = ['arc', 'diff', '--head', head]
+            if upload.revision is None:
+                command.extend(['--create', '--verbatim'])
+            else:
+                command.extend(['--update', upload.revision, '--message', self._message])
+            command.append(patch.base)
+
+            with self._slots:
+                self._run(upload, command)
+        finally:
+            upload.done.set()
+
+    def _run(self, upload, command):
+        import subprocess
+
+        upload.command = command
+        start = time.perf_counter()
+        result = subprocess.run(
+            command,
+            cwd=self._work_dir,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True)
+        if trace.recorder is not None:
+            trace.record(command, 'arc', start, result.stdout)
+        upload.output = result.stdout
+        upload.returncode = result.returncode
+
+        if result.returncode == 0 and upload.revision is None:
+            matches = re.search(REVISION_URI_RE, result.stdout)
+            if matches is not None:
+                upload.revision_url = matches.group(1)
+                upload.revision = matches.group(2)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+import json
+import os
+
+'''
+On-disk memo of what gack learned by reading a patch's commit messages.
+Entries are keyed by the patch name and remember the tip and parent SHAs they
+were computed from, so a moved ref simply stops matching and gets recomputed.
+'''
+class RevisionCache:
+    VERSION = 3
+
+    def __init__(self, path):
+        self._path = path
+        self._entries = None
+        self._dirty = False
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            self._entries = {}
+            try:
+                with open(self._path) as f:
+                    data = json.load(f)
+                if data.get('version') == RevisionCache.VERSION:
+                    self._entries = data['patches']
+            except (OSError, ValueError, KeyError):
+                # a missing or corrupt cache is just an empty one
+                pass
+        return self._entries
+
+    def get(self, name, sha, parent_sha):
+        entry = self.entries.get(name)
+        if entry is None or entry['sha'] != sha or entry['parent_sha'] != parent_sha:
+            return None
+        return entry
+
+    def put(self, name, sha, parent_sha, **fields):
+        entry = dict(fields)
+        entry['sha'] = sha
+        entry['parent_sha'] = parent_sha
+        if self.entries.get(name) != entry:
+            self.entries[name] = entry
+            self._dirty = True
+
+    def retain(self, names):
+        for name in list(self.entries):
+            if name not in names:
+                del self.entries[name]
+                self._dirty = True
+
+    def save(self):
+        if not self._dirty:
+            return
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        tmp_path = '{}.tmp'.format(self._path)
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': RevisionCache.VERSION, 'patches': self.entries}, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self._path)
+        self._dirty = False
@@ -0,0 +1,486 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import sys
+import textwrap
+
+from gack import GackRepo
+
+PROG='gack'
+HELP_STRINGS = {
+    'init': 'Initialize a git repo for gack',
+    'show': 'Show gack stack',
+    'deinit': 'Deinitialize a gack repo',
+    'push': 'Push a patch in gack',
+    'pop': 'Pop a patch in gack',
+    'untrack': 'Stop tracking a patch in gack',
+    'diff': 'Show diff since previous patch in gack',
+    'log': 'Show logs since previous patch in gack',
+    'rebase': 'Interactive rebase to last patch',
+    'restack': 'Rebase patches onto their parents without checking them out',
+    'check': 'Predict which patches conflict with their parents',
+    'move': 'Move a patch to another position in the stack without checking out',
+    'swap': 'Swap a patch with the one below it without checking out',
+    'sync': 'Fetch the stack root, restack onto it and push every patch at once',
+    'absorb': 'Commit working tree changes into the patches that last touched those lines',
+    'undo': 'Put the stack back the way it was before the last gack command that changed it',
+    'redo': 'Redo what gack undo undid',
+    'export': 'Write every patch of the stack to a directory, for gack import elsewhere',
+    'import': 'Rebuild a stack written by gack export',
+    'edit': 'Edit the gack stack file',
+    'stacks': 'List, create and switch between named stacks',
+    'arcdiff': 'Upload current patch as a diff through arc',
+    'arcland': 'Land current patch through arc',
+    'depends': 'Add or fix the Depends on line of every patch without checking out',
+    'prompt': 'Print the current patch for a shell prompt',
+    'serve': 'Run a daemon that answers show and check from warm caches',
+    'worktrees': 'Check patches out into a pool of worktrees instead of switching branches',
+}
+
+class ArgParser:
+
+    def __init__(self):
+        pass
+
+    def parse_args(self, argv):
+        parser = argparse.ArgumentParser(
+                prog=PROG,
+                formatter_class=argparse.RawDescriptionHelpFormatter,
+                description=textwrap.dedent('''
+                gack - Git Stacking utilities
+
+                Repo Management:
+                  init      {init}
+                  deinit    {deinit}
+
+                Stack Operations:
+                  show      {show}
+                  push      {push}
+                  pop       {pop}
+                  diff      {diff} 
+                  log       {log} 
+                  rebase    {rebase}
+                  restack   {restack}
+                  check     {check}
+                  move      {move}
+                  swap      {swap}
+                  sync      {sync}
+                  absorb    {absorb}
+                  edit      {edit}
+                  untrack   {untrack}
+                  stacks    {stacks}
+                  undo      {undo}
+                  redo      {redo}
+                  export    {export}
+                  import    {import}
+
+                Shell Integration:
+                  prompt    {prompt}
+                  serve     {serve}
+                  worktrees {worktrees}
+
+                Arcanist/Phabricator Integrations:
+                  arcdiff   {arcdiff}
+                  arcland   {arcland}
+                  depends   {depends}
+
+                Global Options (before the command):
+                  --trace[=FILE.json]  Report every git call gack makes, or write a Chrome trace
+                  --profile[=FILE]     Run under cProfile, or dump the stats to FILE
+
+                Run '%(prog)s <command> --help' for more information on a command.
+                '''.format(**HELP_STRINGS)),
+                usage='%(prog)s <command> [<args>]')
+        parser.add_argument('command', help='Command to run')
+
+        if len(argv) == 0:
+            parser.print_help()
+            exit(1)
+
+        args = parser.parse_args(argv[0:1])
+        command = args.command
+        if not hasattr(self, command):
+            print('Unrecongized command: {}'.format(command))
+            parser.print_help()
+            exit(1)
+        else:
+            return command, getattr(self, command)(argv[1:])
+
+    def init(self, argv):
+        parser = argparse.ArgumentParser(
+                prog=PROG,
+                usage='%(prog)s init',
+                description=HELP_STRINGS['init'])
+        parser.add_argument('stack_root', default='master', help='Ref that acts as the bottom of the stack, defaults to master')
+        return parser.parse_args(argv)
+
+    def show(self, argv):
+        parser = argparse.ArgumentParser(
+                prog=PROG,
+                usage='%(prog)s show',
+                description=HELP_STRINGS['show'])
+        group = parser.add_mutually_exclusive_group()
+        group.add_argument('--phab', action='store_true', help='Also show Phabrication links')
+        group.add_argument('--json', action='store_true', help='Print the stack and the status of every patch as JSON')
+        return parser.parse_args(argv)
+
+    def deinit(self, argv):
+        parser = argparse.ArgumentParser(
+                prog=PROG,
+                usage='%(prog)s deinit',
+                description=HELP_STRINGS['deinit'])
+        return parser.parse_args(argv)
+
+    def push(self, argv):
+        parser = argparse.ArgumentParser(
+                prog=PROG,
+                usage='%(prog)s push',
+                description=HELP_STRINGS['push'])
+        group = parser.add_mutually_exclusive_group()
+        group.add_argument('--branch', help='If provided, push the branch into gack')
+        group.add_argument('--new', help='If provided, crease and push a new branch into gack')
+        group.add_argument('--rebase', action='store_true', help='If provided, automatically rebase')
+        return parser.parse_args(argv)
+
+    def pop(self, argv):
+        parser = argparse.ArgumentParser(
+                prog=PROG,
+                usage='%(prog)s pop',
+                description=HELP_STRINGS['pop'])
+        parser.add_argument('--all', action='store_true', help='Pop all branches')
+        return parser.parse_args(argv)
+
+    def diff(self, argv):
+        parser = argparse.ArgumentParser(
+                prog=PROG,
+                usage='%(prog)s diff',
+                description=HELP_STRINGS['diff'])
+        return parser.parse_args(argv)
+
+    def rebase(self, argv):
+        parser = argparse.ArgumentParser(
+                prog=PROG,
+                usage='%(prog)s rebase',
+                description=HELP_STRINGS['rebase'])
+        return parser.parse_args(argv)
+
+    def restack(self, argv):
+        parser = argparse.ArgumentParser(
+                prog=PROG,
+                usage='%(prog)s restack',
+                description=HELP_STRINGS['restack'])
+        parser.add_argument('--all', action='store_true', help='Restack every patch in the stack, not just the current one')
+        return parser.parse_args(argv)
+
+    def move(self, argv):
+        parser = argparse.ArgumentParser(
+                prog=PROG,
+                usage='%(prog)s move <patch> --to <index>',
+                description=HELP_STRINGS['move'])
+        parser.add_argument('patch', help='Patch to move')
+        parser.add_argument('--to', type=int, required=True, help='New position, 1 being the patch right above the root')
+        return parser.parse_args(argv)
+
+    def swap(self, argv):
+        parser = argparse.ArgumentParser(
+                prog=PROG,
+                usage='%(prog)s swap [<patch>]',
+                description=HELP_STRINGS['swap'])
+        parser.add_argument('patch', nargs='?', help='Patch to swap, defaults to the current patch')
+        return parser.parse_args(argv)
+
+    def sync(self, argv):
+        parser = argparse.ArgumentParser(
+                prog=PROG,
+                usage='%(prog)s sync',
+                description=HELP_STRINGS['sync'])
+        return parser.parse_args(argv)
+
+    def absorb(self, argv):
+        parser = argparse.ArgumentParser(
+                prog=PROG,
+                usage='%(prog)s absorb',
+                description=HELP_STRINGS['absorb'])
+        return parser.parse_args(argv)
+
+    def undo(self, argv):
+        parser = argparse.ArgumentParser(
+                prog=PROG,
+                usage='%(prog)s undo',
+                description=HELP_STRINGS['undo'])
+        return parser.parse_args(argv)
+
+    def redo(self, argv):
+        parser = argparse.ArgumentParser(
+                prog=PROG,
+                usage='%(prog)s redo',
+                description=HELP_STRINGS['redo'])
+        return parser.parse_args(argv)
+
+    def export(self, argv):
+        from gack.series import FORMATS, DEFAULT_FORMAT
+
+        parser = argparse.ArgumentParser(
+                prog=PROG,
+                usage='%(prog)s export <dir>',
+                description=HELP_STRINGS['export'])
+        parser.add_argument('path', metavar='dir', help='Directory to write to; must be empty or missing')
+        parser.add_argument('--format', choices=sorted(FORMATS), default=DEFAULT_FORMAT,
+                            help='stream rebuilds the exact commits with gack import, mbox is for reading and mailing')
+        parser.add_argument('--jobs', type=int, default=None, help='Number of patches to export at once')
+        return parser.parse_args(argv)
+
+    def import_(self, argv):
+        parser = argparse.ArgumentParser(
+                prog=PROG,
+                usage='%(prog)s import <dir>',
+                description=HELP_STRINGS['import'])
+        parser.add_argument('path', metavar='dir', help='Directory written by gack export')
+        parser.add_argument('--stack', default=None, help='Name of the new stack, defaults to the exported one')
+        return parser.parse_args(argv)
+
+    def check(self, argv):
+        parser = argparse.ArgumentParser(
+                prog=PROG,
+                usage='%(prog)s check',
+                description=HELP_STRINGS['check'])
+        parser.add_argument('--jobs', type=int, default=None, help='Number of trial merges to run at once')
+        return parser.parse_args(argv)
+
+    def stacks(self, argv):
+        parser = argparse.ArgumentParser(
+                prog=PROG,
+                usage='%(prog)s stacks',
+                description=HELP_STRINGS['stacks'])
+        group = parser.add_mutually_exclusive_group()
+        group.add_argument('--new', metavar='NAME', help='Create a stack and switch to it')
+        group.add_argument('--switch', metavar='NAME', help='Switch to another stack')
+        group.add_argument('--delete', metavar='NAME', help='Stop tracking a stack; its branches are kept')
+        parser.add_argument('--root', default='master', help='Bottom of a stack created with --new, defaults to master')
+        return parser.parse_args(argv)
+
+    def edit(self, argv):
+        parser = argparse.ArgumentParser(
+                prog=PROG,
+                usage='%(prog)s edit',
+                description=HELP_STRINGS['edit'])
+        return parser.parse_args(argv)
+
+    def log(self, argv):
+        parser = argparse.ArgumentParser(
+                prog=PROG,
+                usage='%(prog)s log',
+                description=HELP_STRINGS['log'])
+        return parser.parse_args(argv)
+
+    def untrack(self, argv):
+        parser = argparse.ArgumentParser(
+                prog=PROG,
+                usage='%(prog)s untrack',
+                description=HELP_STRINGS['untrack'])
+        parser.add_argument('branch', help='Stop tracking the branch in gack; it remains tracked by git unless --delete is specified')
+        parser.add_argument('--delete', action='store_true', help='Also forcibly delete the branch')
+        return parser.parse_args(argv)
+
+    def arcdiff(self, argv):
+        parser = argparse.ArgumentParser(
+                prog=PROG,
+                usage='%(prog)s arcdiff',
+                description=HELP_STRINGS['arcdiff'])
+        group = parser.add_mutually_exclusive_group()
+        group.add_argument('--edit', action='store_true', help='Edit before updating diff')
+        group.add_argument('--all', action='store_true', help='Upload every patch in the stack, several at a time')
+        parser.add_argument('--message', default='Updated with gack arcdiff --all', help='Update message used by --all')
+        parser.add_argument('--jobs', type=int, default=None, help='Number of arc processes --all runs at once')
+        return parser.parse_args(argv)
+
+    def depends(self, argv):
+        parser = argparse.ArgumentParser(
+                prog=PROG,
+                usage='%(prog)s depends',
+                description=HELP_STRINGS['depends'])
+        return parser.parse_args(argv)
+
+    def serve(self, argv):
+        parser = argparse.ArgumentParser(
+                prog=PROG,
+                usage='%(prog)s serve',
+                description=HELP_STRINGS['serve'])
+        parser.add_argument('--stop', action='store_true', help='Stop the running daemon')
+        return parser.parse_args(argv)
+
+    def worktrees(self, argv):
+        parser = argparse.ArgumentParser(
+                prog=PROG,
+                usage='%(prog)s worktrees',
+                description=HELP_STRINGS['worktrees'])
+        group = parser.add_mutually_exclusive_group()
+        group.add_argument('--enable', type=int, metavar='SIZE', help='Enable the pool with at most SIZE worktrees')
+        group.add_argument('--disable', action='store_true', help='Disable the pool and remove its clean worktrees')
+        parser.add_argument('--root', help='Directory to create worktrees in, defaults to <repo>.worktrees')
+        return parser.parse_args(argv)
+
+    def arcland(self, argv):
+        parser = argparse.ArgumentParser(
+                prog=PROG,
+                usage='%(prog)s arcland',
+                description=HELP_STRINGS['arcland'])
+        parser.add_argument('--through', metavar='PATCH', help='Land every patch from the bottom of the stack up to PATCH, then restack the rest')
+        return parser.parse_args(argv)
+
+    def log(self, argv):
+        parser = argparse.ArgumentParser(
+                prog=PROG,
+                usage='%(prog)s log',
+                description='Print some logs')
+        return parser.parse_args(argv)
+
+    def debug(self, argv):
+        parser = argparse.ArgumentParser(
+                prog=PROG,
+                usage='%(prog)s debug',
+                description='Do some debugging')
+        return parser.parse_args(argv)
+
+# `import` is a keyword, so its parser cannot be defined under that name
+setattr(ArgParser, 'import', ArgParser.import_)
+
+def init(repo, args):
+    if not repo.is_initialized:
+        repo.initialize_repo(args.stack_root)
+    else:
+        print('This repo is already initialized!')
+
+def show(repo, args):
+    if args.json:
+        repo.print_stack_json()
+    else:
+        repo.print_stack(show_phab=args.phab)
+
+def deinit(repo, args):
+    response = input('gack will stop tracking your stack, are you sure? (y/N)')
+    if response == 'y' or response == 'Y':
+        repo.deinitialize()
+
+def push(repo, args):
+    if args.branch is not None:
+        repo.push_existing_branch(args.branch, args.rebase)
+    elif args.new is not None:
+        repo.push_new_branch(args.new)
+    else:
+        repo.push_one(args.rebase)
+
+def absorb(repo, args):
+    if not repo.absorb():
+        sys.exit(1)
+
+def arcland(repo, args):
+    if args.through is not None:
+        if not repo.arc_land_through(args.through):
+            sys.exit(1)
+    else:
+        repo.arc_land()
+
+def stacks(repo, args):
+    if args.new is not None:
+        repo.new_stack(args.new, args.root)
+    elif args.switch is not None:
+        repo.switch_stack(args.switch)
+    elif args.delete is not None:
+        repo.delete_stack(args.delete)
+    else:
+        repo.print_stacks()
+
+def check(repo, args):
+    if repo.check(jobs=args.jobs) > 0:
+        sys.exit(1)
+
+def restack(repo, args):
+    if not repo.restack(all=args.all):
+        sys.exit(1)
+
+def move(repo, args):
+    if not repo.move(args.patch, args.to):
+        sys.exit(1)
+
+def swap(repo, args):
+    if not repo.swap(args.patch):
+        sys.exit(1)
+
+def sync(repo, args):
+    if not repo.sync():
+        sys.exit(1)
+
+def arcdiff(repo, args):
+    if args.all:
+        repo.arc_diff_all(message=args.message, jobs=args.jobs)
+    else:
+        repo.arc_diff(edit_diff=args.edit)
+
+# Commands that also run without an active stack
+UNINITIALIZED_COMMANDS = {'init', 'stacks', 'import', 'undo', 'redo'}
+
+COMMANDS = {
+    'init': init,
+    'show': show,
+    'deinit': deinit,
+    'push': push,
+    'pop': lambda repo, args: repo.pop(all=args.all),
+    'diff': lambda repo, args: repo.diff(),
+    'log': lambda repo, args: repo.log(),
+    'rebase': lambda repo, args: repo.rebase_one(),
+    'restack': restack,
+    'check': check,
+    'move': move,
+    'swap': swap,
+    'sync': sync,
+    'absorb': absorb,
+    'undo': lambda repo, args: repo.undo(),
+    'redo': lambda repo, args: repo.redo(),
+    'export': lambda repo, args: repo.export_stack(args.path, format=args.format, jobs=args.jobs),
+    'import': lambda repo, args: repo.import_stack(args.path, name=args.stack),
+    'edit': lambda repo, args: repo.edit_gack_file(),
+    'stacks': stacks,
+    'untrack': lambda repo, args: repo.untrack(branch=args.branch, delete=args.delete),
+    'arcdiff': arcdiff,
+    'arcland': arcland,
+    'depends': lambda repo, args: repo.fix_depends_on(),
+    'serve': lambda repo, args: repo.serve(stop=args.stop),
+    'worktrees': lambda repo, args: repo.worktrees(enable=args.enable, disable=args.disable, root=args.root),
+    'debug': lambda repo, args: repo._debug(),
+}
+
+def forward_to_daemon(command, argv):
+    # True if a running `gack serve` handled the command
+    if not os.path.exists(GackRepo.DAEMON_SOCKET_PATH):
+        return False
+
+    from gack.daemon import SERVED_COMMANDS, forward
+
+    response = None
+    if command in SERVED_COMMANDS:
+        response = forward(GackRepo.DAEMON_SOCKET_PATH, argv)
+    if response is None:
+        return False
+    stdout, stderr, exit_code = response
+    sys.stdout.write(stdout)
+    sys.stderr.write(stderr)
+    if exit_code != 0:
+        sys.exit(exit_code)
+    return True
+
+def main(argv):
+    parser = ArgParser()
+    command, args = parser.parse_args(argv)
+    if command not in COMMANDS:
+        raise Exception('Unknown command!')
+    if forward_to_daemon(command, argv):
+        return
+
+    # GackRepo is cheap to build: GitPython is only loaded by the commands that use it
+    repo = GackRepo()
+    if command not in UNINITIALIZED_COMMANDS and not repo.is_initialized:
+        print('This repo is not a gack repo, run `gack init` to initialize it')
+    else:
+        COMMANDS[command](repo, args)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+from contextlib import redirect_stderr, redirect_stdout
+import io
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+
+from .stackfile import ACTIVE_FILE, active_stack_path
+
+# Read-only, non-interactive commands the daemon may answer for the CLI
+SERVED_COMMANDS = {'show', 'check'}
+
+
+def fingerprint(git_dir, common_dir):
+    # Everything a served answer depends on. Git moves refs by renaming lock
+    # files into place, so the mtimes of the refs directories change with
+    # every ref update without having to stat every ref.
+    paths = [
+        os.path.join(git_dir, 'HEAD'),
+        os.path.join(common_dir, 'packed-refs'),
+        os.path.join(common_dir, 'gack', ACTIVE_FILE),
+        active_stack_path(os.path.join(common_dir, 'gack')),
+    ]
+    for root, _, _ in os.walk(os.path.join(common_dir, 'refs')):
+        paths.append(root)
+
+    stamps = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            stamps.append((path, stat.st_mtime_ns, stat.st_size, stat.st_ino))
+        except FileNotFoundError:
+            stamps.append((path, None, None, None))
+    return stamps
+
+
+def send(socket_path, request):
+    # Returns the daemon's response, or None when no daemon is listening
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+        client.sendall(json.dumps(request).encode() + b'\n')
+        response = client.makefile('rb').readline()
+    except OSError:
+        return None
+    finally:
+        client.close()
+    return json.loads(response) if response else None
+
+
+def forward(socket_path, argv):
+    # Returns (stdout, stderr, exit code) of a command run by the daemon, or
+    # None, in which case the CLI does the work itself
+    response = send(socket_path, {'argv': argv})
+    if response is None:
+        return None
+    return response['stdout'], response['stderr'], response['exit']
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        response = self.server.daemon.answer(request)
+        self.wfile.write(json.dumps(response).encode() + b'\n')
+
+
+'''
+`gack serve`: answers CLI requests from one long-lived GackRepo, so the
+GitPython handle, the parsed stack and the computed stack status stay warm
+between calls. Before each request the daemon compares the ref and stack
+file fingerprint with the one its caches were built from, and drops them if
+anything moved.
+'''
+class Daemon:
+
+    def __init__(self, repo, socket_path, git_dir, common_dir):
+        self._repo = repo
+        self.socket_path = socket_path
+        self._git_dir = git_dir
+        self._common_dir = common_dir
+        self._fingerprint = None
+        self.server = None
+
+    def answer(self, request):
+        from .cli import ArgParser, COMMANDS
+
+        if request.get('ping'):
+            return {'stdout': '', 'stderr': '', 'exit': 0}
+        if request.get('stop'):
+            # shutdown() waits for this very request to finish, so not from here
+            threading.Thread(target=self.server.shutdown).start()
+            return {'stdout': 'gack daemon stopped\n', 'stderr': '', 'exit': 0}
+
+        current = fingerprint(self._git_dir, self._common_dir)
+        if current != self._fingerprint:
+            self._repo.refresh()
+            self._fingerprint = current
+
+        stdout = io.StringIO()
+        stderr = io.StringIO()
+        exit_code = 0
+        with redirect_stdout(stdout), redirect_stderr(stderr):
+            try:
+                command, args = ArgParser().parse_args(request['argv'])
+                if command not in SERVED_COMMANDS:
+                    raise Exception('gack serve does not run {}'.format(command))
+                COMMANDS[command](self._repo, args)
+            except SystemExit as e:
+                exit_code = e.code if isinstance(e.code, int) else 1
+            except Exception as e:
+                print('gack serve: {}'.format(e), file=sys.stderr)
+                exit_code = 1
+        return {'stdout': stdout.getvalue(), 'stderr': stderr.getvalue(), 'exit': exit_code}
+
+    def serve(self):
+        if send(self.socket_path, {'ping': True}) is not None:
+            print('A gack daemon is already serving this repo')
+            return
+        if os.path.exists(self.socket_path):
+            # left behind by a daemon that did not shut down cleanly
+            os.remove(self.socket_path)
+
+        self.server = socketserver.UnixStreamServer(self.socket_path, RequestHandler)
+        self.server.daemon = self
+        print('gack daemon listening on {}'.format(self.socket_path))
+        try:
+            self.server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.server.server_close()
+            os.remove(self.socket_path)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+import functools
+import json
+import os
+import time
+
+ENTRY_SUFFIX = '.json'
+REDO_DIR = 'redo'
+
+
+def journaled(operation):
+    # Decorates a GackRepo method that may move branches or rewrite the stack
+    # file: the state before it runs is journaled first, so even an
+    # operation that fails halfway can be undone, and dropped again if the
+    # operation turned out to change nothing
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(repo, *args, **kwargs):
+            entry = repo._journal_begin(operation)
+            try:
+                return method(repo, *args, **kwargs)
+            finally:
+                repo._journal_end(entry)
+        return wrapper
+    return decorate
+
+
+'''
+What gack can undo: one small JSON file per operation under
+`.git/gack/journal/`, holding the SHA of every branch in the stack and the
+stack file as they were before the operation. Undoing an entry moves it,
+with the state it replaces, to `redo/`, and redoing moves it back; any new
+operation forgets what could be redone. Entries are numbered, so the latest
+one is found without reading the others, and old ones are pruned by count
+and by age.
+'''
+class Journal:
+    MAX_ENTRIES = 100
+    MAX_AGE = 30 * 24 * 60 * 60
+
+    def __init__(self, path):
+        self._path = path
+
+    def _dir(self, redo):
+        return os.path.join(self._path, REDO_DIR) if redo else self._path
+
+    def _numbers(self, redo=False):
+        try:
+            names = os.listdir(self._dir(redo))
+        except FileNotFoundError:
+            return []
+        return sorted(int(name[:-len(ENTRY_SUFFIX)]) for name in names if name.endswith(ENTRY_SUFFIX))
+
+    def _entry_path(self, number, redo=False):
+        return os.path.join(self._dir(redo), '{:08d}{}'.format(number, ENTRY_SUFFIX))
+
+    def append(self, entry, redo=False):
+        # Returns the path the entry was written to
+        numbers = self._numbers(redo)
+        path = self._entry_path(numbers[-1] + 1 if numbers else 1, redo)
+        os.makedirs(self._dir(redo), exist_ok=True)
+        tmp_path = '{}.tmp'.format(path)
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f, sort_keys=True)
+        os.replace(tmp_path, path)
+        return path
+
+    def last(self, redo=False):
+        # Returns (path, entry) of the newest entry, or (None, None)
+        numbers = self._numbers(redo)
+        if len(numbers) == 0:
+            return None, None
+        path = self._entry_path(numbers[-1], redo)
+        with open(path) as f:
+            return path, json.load(f)
+
+    def remove(self, path):
+        os.remove(path)
+
+    def clear_redo(self):
+        for number in self._numbers(redo=True):
+            os.remove(self._entry_path(number, redo=True))
+
+    def prune(self, now=None):
+        now = now or time.time()
+        numbers = self._numbers()
+        for i, number in enumerate(numbers):
+            path = self._entry_path(number)
+            if i < len(numbers) - self.MAX_ENTRIES or os.path.getmtime(path) < now - self.MAX_AGE:
+                os.remove(path)
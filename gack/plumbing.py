@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+import os
+import time
+
+from . import trace
+
+'''
+Thin runner for the git plumbing commands whose output gack parses itself.
+GitPython hides a subprocess behind many innocent-looking attributes, so the
+hot paths talk to git through here instead, where every spawn is explicit.
+'''
+class Git:
+    # Read size for streamed output
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, work_dir):
+        self._work_dir = work_dir
+        self._version = None
+
+    @property
+    def version(self):
+        if self._version is None:
+            # "git version 2.39.5" or "git version 2.39.5.windows.1"
+            numbers = self.run('version').split()[2].split('.')
+            self._version = tuple(int(n) for n in numbers[:2] if n.isdigit())
+        return self._version
+
+    def run(self, *args, input=None, check=True, env=None, binary=False):
+        return self.run_with_status(*args, input=input, check=check, env=env, binary=binary)[1]
+
+    def run_with_status(self, *args, input=None, check=True, env=None, binary=False):
+        # Deferred so commands that never reach git do not import it
+        import subprocess
+
+        if env is not None:
+            env = dict(os.environ, **env)
+        start = time.perf_counter()
+        result = subprocess.run(
+            ['git'] + list(args),
+            cwd=self._work_dir,
+            input=input,
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=not binary)
+        if trace.recorder is not None:
+            trace.record(['git'] + list(args), 'plumbing', start, result.stdout)
+        if check and result.returncode != 0:
+            stderr = result.stderr.decode(errors='replace') if binary else result.stderr
+            raise GitError(args, result.returncode, stderr, result.stdout)
+        return result.returncode, result.stdout
+
+    def records(self, *args):
+        # For `-z` output: yields one NUL-terminated record per object as git
+        # writes them, so the whole output is never held in memory at once
+        import subprocess
+
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            ['git'] + list(args),
+            cwd=self._work_dir,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        output_bytes = 0
+        pending = b''
+        try:
+            while True:
+                chunk = process.stdout.read1(self.CHUNK_SIZE)
+                if len(chunk) == 0:
+                    break
+                output_bytes += len(chunk)
+                *complete, pending = (pending + chunk).split(b'\0')
+                for record in complete:
+                    if record:
+                        yield record.decode(errors='replace')
+            if pending:
+                yield pending.decode(errors='replace')
+            stderr = process.stderr.read().decode(errors='replace')
+            if process.wait() != 0:
+                raise GitError(args, process.returncode, stderr)
+        finally:
+            if process.poll() is None:
+                # the caller stopped reading early
+                process.kill()
+                process.wait()
+            process.stdout.close()
+            process.stderr.close()
+            if trace.recorder is not None:
+                trace.record(['git'] + list(args), 'plumbing', start, output_bytes=output_bytes)
+
+    def update_refs(self, updates, message):
+        # updates is a list of (refname, new_sha, old_sha); either every ref
+        # moves or, if any of them is no longer at old_sha, none of them do.
+        # message goes into the reflog of each ref.
+        if len(updates) == 0:
+            return
+        lines = ['start']
+        for refname, new_sha, old_sha in updates:
+            lines.append('update {} {} {}'.format(refname, new_sha, old_sha or ''))
+        lines.extend(['prepare', 'commit'])
+        self.run('update-ref', '-m', message, '--stdin', input='\n'.join(lines) + '\n')
+
+
+class GitError(Exception):
+
+    def __init__(self, args, returncode, stderr, stdout=None):
+        super().__init__('git {} failed ({}): {}'.format(' '.join(args), returncode, stderr.strip()))
+        self.returncode = returncode
+        self.stderr = stderr
+        # some commands, like `push --porcelain`, report failures on stdout
+        self.stdout = stdout
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+
+from .refs import RefStore, find_git_dir
+from .stackfile import active_stack_path, parse
+
+DEFAULT_FORMAT = '{patch} {index}/{depth}'
+
+USAGE = '''usage: gack prompt [--format FORMAT]
+
+Print the current patch for a shell prompt. Prints nothing outside a gack repo
+or when the current branch is not in the stack.
+
+FORMAT may use {patch}, {index} and {depth}; it defaults to "%s".
+''' % DEFAULT_FORMAT
+
+'''
+`gack prompt` fast path. Shell prompts run this on every keypress, so it must
+stay clear of GitPython, argparse and subprocesses: everything it needs is
+read straight from HEAD, the refs and the gack stack file.
+'''
+def prompt(path, format=DEFAULT_FORMAT):
+    dirs = find_git_dir(path)
+    if dirs is None:
+        return None
+    git_dir, common_dir = dirs
+
+    try:
+        with open(active_stack_path(os.path.join(common_dir, 'gack'))) as f:
+            stack = [entry.name for entry in parse(f.read())[1]]
+    except FileNotFoundError:
+        return None
+
+    refs = RefStore(git_dir, common_dir)
+    branch, head_sha = refs.head()
+    index = stack.index(branch) if branch in stack else -1
+    if index < 0 and head_sha is not None:
+        # detached HEAD: it still counts if it sits exactly on a patch
+        for i in range(len(stack) - 1, -1, -1):
+            if refs.resolve(stack[i])[1] == head_sha:
+                index = i
+                break
+    if index < 0:
+        return None
+
+    return format.format(patch=stack[index], index=index, depth=len(stack) - 1)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    format = DEFAULT_FORMAT
+    i = 0
+    while i < len(argv):
+        if argv[i] in ('-h', '--help'):
+            print(USAGE)
+            return
+        elif argv[i] == '--format' and i + 1 < len(argv):
+            format = argv[i + 1]
+            i += 1
+        elif argv[i].startswith('--format='):
+            format = argv[i][len('--format='):]
+        else:
+            print(USAGE, file=sys.stderr)
+            sys.exit(1)
+        i += 1
+
+    # a bad format fails the same way inside a repo or not
+    try:
+        format.format(patch='', index=0, depth=0)
+    except (KeyError, IndexError, ValueError):
+        print(USAGE, file=sys.stderr)
+        sys.exit(1)
+
+    output = prompt(os.getcwd(), format)
+    if output is not None:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+import os
+
+# Order in which git itself disambiguates a short ref name (see gitrevisions(7))
+REF_PREFIXES = ['', 'refs/', 'refs/tags/', 'refs/heads/', 'refs/remotes/']
+
+HEADS_PREFIX = 'refs/heads/'
+REMOTES_PREFIX = 'refs/remotes/'
+
+
+def find_git_dir(path):
+    # Returns (git_dir, common_dir) for the repo containing path, or None.
+    # Linked worktrees have a `.git` file pointing at their own git dir, which
+    # shares refs and everything else under the main repo's common dir.
+    path = os.path.abspath(path)
+    while True:
+        dot_git = os.path.join(path, '.git')
+        if os.path.isdir(dot_git):
+            return dot_git, dot_git
+        if os.path.isfile(dot_git):
+            with open(dot_git) as f:
+                git_dir = f.read().strip()[len('gitdir:'):].strip()
+            git_dir = os.path.normpath(os.path.join(path, git_dir))
+            common_dir = git_dir
+            if os.path.isfile(os.path.join(git_dir, 'commondir')):
+                with open(os.path.join(git_dir, 'commondir')) as f:
+                    common_dir = os.path.normpath(os.path.join(git_dir, f.read().strip()))
+            return git_dir, common_dir
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+'''
+Reads refs straight out of the git directory: HEAD, loose ref files and
+packed-refs. Nothing here imports GitPython or starts a git process, so it is
+cheap enough for a shell prompt. Only regular refs are understood; anything
+more exotic (reftable, refs only known to a ref backend) reads as missing.
+
+It doubles as the per-invocation ref index: packed-refs is parsed once and
+every name looked up is remembered, so no lookup ever lists all branches.
+Anything that moves a ref must call invalidate() before reading it again.
+'''
+class RefStore:
+
+    def __init__(self, git_dir, common_dir=None):
+        self._git_dir = git_dir
+        self._common_dir = common_dir or git_dir
+        self._packed = None
+        self._index = {}
+
+    def invalidate(self):
+        self._packed = None
+        self._index = {}
+
+    @property
+    def packed(self):
+        if self._packed is None:
+            self._packed = {}
+            try:
+                with open(os.path.join(self._common_dir, 'packed-refs')) as f:
+                    refname = None
+                    for line in f:
+                        if line.startswith('#'):
+                            continue
+                        elif line.startswith('^'):
+                            # peeled value of the annotated tag on the previous line
+                            self._packed[refname] = line[1:].strip()
+                        else:
+                            sha, refname = line.split()
+                            self._packed[refname] = sha
+            except FileNotFoundError:
+                pass
+        return self._packed
+
+    def _read_loose(self, refname):
+        # HEAD and other pseudo-refs are per-worktree, everything else is shared
+        base_dir = self._git_dir if '/' not in refname else self._common_dir
+        try:
+            with open(os.path.join(base_dir, refname)) as f:
+                return f.read().strip()
+        except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+            return None
+
+    def read(self, refname):
+        # Full refname -> SHA, following symbolic refs
+        if refname not in self._index:
+            self._index[refname] = self._read(refname, 0)
+        return self._index[refname]
+
+    def _read(self, refname, depth):
+        value = self._read_loose(refname)
+        if value is None:
+            return self.packed.get(refname)
+        if value.startswith('ref:'):
+            if depth >= 5:
+                return None
+            return self._read(value[len('ref:'):].strip(), depth + 1)
+        # FETCH_HEAD and friends carry more than the SHA
+        return value.split()[0] if value else None
+
+    def head(self):
+        # Returns (branch name, SHA); branch is None when HEAD is detached
+        value = self._read_loose('HEAD')
+        if value is None:
+            return None, None
+        if value.startswith('ref:'):
+            refname = value[len('ref:'):].strip()
+            branch = refname[len(HEADS_PREFIX):] if refname.startswith(HEADS_PREFIX) else refname
+            return branch, self._read(refname, 0)
+        return None, value
+
+    def resolve(self, name):
+        # Short name -> (full refname, SHA), or (None, None)
+        for prefix in REF_PREFIXES:
+            if prefix == '' and not name.replace('_', '').isupper():
+                # only pseudo-refs like HEAD live at the top of the git dir
+                continue
+            sha = self.read(prefix + name)
+            if sha is not None:
+                return prefix + name, sha
+        return None, None
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import re
+
+CommitObject = namedtuple('CommitObject', ['sha', 'tree', 'parents', 'author', 'message'])
+
+AUTHOR_RE = r'^(.*) <(.*)> (\d+ [+-]\d{4})$'
+
+# `git merge-tree --write-tree`, which every in-memory merge runs
+MIN_GIT_VERSION = (2, 38)
+
+# Fixed identity for the throwaway commits used to pin a merge base on old gits
+SCRATCH_ENV = {
+    'GIT_AUTHOR_NAME': 'gack',
+    'GIT_AUTHOR_EMAIL': 'gack@localhost',
+    'GIT_AUTHOR_DATE': '946684800 +0000',
+    'GIT_COMMITTER_NAME': 'gack',
+    'GIT_COMMITTER_EMAIL': 'gack@localhost',
+    'GIT_COMMITTER_DATE': '946684800 +0000',
+}
+
+
+def require_merge_tree(git):
+    # Fails before anything is replayed rather than at the first merge
+    if git.version < MIN_GIT_VERSION:
+        raise Exception('gack needs git {} or later to replay patches, this is git {}'.format(
+            '.'.join(str(n) for n in MIN_GIT_VERSION), '.'.join(str(n) for n in git.version)))
+
+
+class ReplayConflict(Exception):
+
+    def __init__(self, patch, commit, paths):
+        super().__init__('{} conflicts while replaying {}'.format(patch, commit[:12]))
+        self.patch = patch
+        self.commit = commit
+        self.paths = paths
+
+
+'''
+Cherry-picks commits purely at the object level: every merge happens in
+`git merge-tree` and every new commit is written with `git commit-tree`, so
+neither the index nor the working tree is read or written.
+'''
+class Replayer:
+
+    def __init__(self, git):
+        self._git = git
+        self._objects = {}
+        # --merge-base lets merge-tree cherry-pick directly (git 2.40+)
+        self._has_merge_base = git.version >= (2, 40)
+
+    def load(self, shas):
+        # One `cat-file --batch` process reads every commit we are going to touch
+        missing = [sha for sha in shas if sha not in self._objects]
+        if len(missing) == 0:
+            return
+        output = self._git.run('cat-file', '--batch', input='\n'.join(missing).encode() + b'\n', binary=True)
+        offset = 0
+        while offset < len(output):
+            header_end = output.index(b'\n', offset)
+            sha, kind, size = output[offset:header_end].decode().split()
+            body = output[header_end + 1:header_end + 1 + int(size)]
+            offset = header_end + 1 + int(size) + 1
+            if kind == 'commit':
+                self._objects[sha] = self._parse_commit(sha, body.decode(errors='replace'))
+
+    def commit(self, sha):
+        if sha not in self._objects:
+            self.load([sha])
+        return self._objects[sha]
+
+    def _parse_commit(self, sha, body):
+        headers, _, message = body.partition('\n\n')
+        tree = None
+        parents = []
+        author = None
+        for line in headers.split('\n'):
+            key, _, value = line.partition(' ')
+            if key == 'tree':
+                tree = value
+            elif key == 'parent':
+                parents.append(value)
+            elif key == 'author':
+                author = re.match(AUTHOR_RE, value).groups()
+        return CommitObject(sha, tree, parents, author, message)
+
+    def pick(self, patch, sha, onto, message=None):
+        commit = self.commit(sha)
+        if message is None and commit.parents[:1] == [onto]:
+            # already in place, keep the original object
+            return sha
+        onto_commit = self.commit(onto)
+        base_tree = self.commit(commit.parents[0]).tree if commit.parents else None
+
+        if base_tree == onto_commit.tree:
+            # nothing changed underneath, the commit's own tree is the result
+            tree = commit.tree
+        else:
+            tree = self._merge(patch, commit, onto_commit, base_tree)
+
+        return self._write(tree, onto, commit.author, commit.message if message is None else message)
+
+    def squash(self, sha, onto, message):
+        # One commit on onto holding sha's tree, by sha's author: when onto is
+        # in sha's history, every commit between them folded into one
+        commit = self.commit(sha)
+        return self._write(commit.tree, onto, commit.author, message)
+
+    def _write(self, tree, parent, author, message):
+        name, email, date = author
+        new_sha = self._git.run(
+            'commit-tree', tree, '-p', parent,
+            input=message,
+            env={'GIT_AUTHOR_NAME': name, 'GIT_AUTHOR_EMAIL': email, 'GIT_AUTHOR_DATE': date}).strip()
+        self._objects[new_sha] = CommitObject(new_sha, tree, [parent], author, message)
+        return new_sha
+
+    def _merge(self, patch, commit, onto_commit, base_tree):
+        if self._has_merge_base and len(commit.parents) > 0:
+            args = ['--merge-base={}'.format(commit.parents[0]), onto_commit.sha, commit.sha]
+        else:
+            # Give both sides a common scratch ancestor holding the base tree
+            if base_tree is None:
+                base_tree = self._git.run('hash-object', '-t', 'tree', '-w', '--stdin', input='').strip()
+            base = self._scratch_commit(base_tree)
+            args = [self._scratch_commit(onto_commit.tree, base), self._scratch_commit(commit.tree, base)]
+
+        status, output = self._git.run_with_status(
+            'merge-tree', '--write-tree', '--name-only', '--no-messages', *args,
+            check=False)
+        lines = output.splitlines()
+        if status == 1:
+            raise ReplayConflict(patch, commit.sha, sorted(set(line for line in lines[1:] if line)))
+        elif status != 0:
+            raise Exception('git merge-tree failed while replaying {}'.format(commit.sha))
+        return lines[0]
+
+    def _scratch_commit(self, tree, parent=None):
+        args = ['commit-tree', tree]
+        if parent is not None:
+            args.extend(['-p', parent])
+        return self._git.run(*args, input='gack scratch', env=SCRATCH_ENV).strip()
+
+    def replay(self, patch, commits, onto, messages=None):
+        # commits are newest-first, as StackSnapshot records them; messages
+        # optionally maps a commit's sha to a new message for its copy
+        messages = messages or {}
+        self.load([commit.sha for commit in commits] + [onto] +
+                  [commit.parents[0] for commit in commits if commit.parents])
+        tip = onto
+        for commit in reversed(commits):
+            tip = self.pick(patch, commit.sha, tip, messages.get(commit.sha))
+        return tip
+
+
+'''
+Rebases patches [start, end) of a snapshot onto their (possibly rewritten)
+parents in memory. Returns (PatchStatus, new tip, new base) for every patch
+that moved, in stack order, and the conflict that stopped the replay, if any.
+'''
+def restack(git, snapshot, start, end):
+    require_merge_tree(git)
+    replayer = Replayer(git)
+    updates = []
+    new_tips = {}
+    for i in range(start, end):
+        patch = snapshot.patches[i]
+        parent = snapshot.patches[i - 1]
+        onto = new_tips.get(i - 1, parent.sha)
+        if patch.sha is None or onto is None:
+            continue
+        if patch.base == onto:
+            # already sits on its parent
+            continue
+        try:
+            new_sha = replayer.replay(patch.name, patch.commits, onto)
+        except ReplayConflict as conflict:
+            return updates, conflict
+        new_tips[i] = new_sha
+        updates.append((patch, new_sha, onto))
+    return updates, None
+
+
+'''
+Replays a reordered stack. order lists the snapshot's patch indices in their
+new stack order, the root first. From the first position that changed on,
+every patch is replayed onto its new parent unless it already sits on it.
+Nothing is written but objects: on a conflict no update is returned at all,
+so the caller can leave refs and the stack file untouched. Returns
+(updates like restack's, conflict or None).
+'''
+def reorder(git, snapshot, order):
+    require_merge_tree(git)
+    replayer = Replayer(git)
+    updates = []
+    new_tips = {}
+    changed = False
+    for position in range(1, len(order)):
+        i = order[position]
+        patch = snapshot.patches[i]
+        parent_index = order[position - 1]
+        changed = changed or i != position
+        if not changed:
+            continue
+        onto = new_tips.get(parent_index, snapshot.patches[parent_index].sha)
+        if patch.base == onto:
+            continue
+        try:
+            new_tips[i] = replayer.replay(patch.name, patch.commits, onto)
+        except ReplayConflict as conflict:
+            return [], conflict
+        updates.append((patch, new_tips[i], onto))
+    return updates, None
+
+
+'''
+Folds fixup commits into a snapshot's patches. fixups maps a patch index to
+a commit holding that patch's share of the changes, made on top of any patch
+at or above it; it is cherry-picked onto the patch's tip, and every patch
+above a changed one is replayed onto its new parent. Like reorder(), a
+conflict returns no update at all. Returns (updates like restack's, conflict
+or None).
+'''
+def fixup(git, snapshot, fixups):
+    require_merge_tree(git)
+    replayer = Replayer(git)
+    updates = []
+    new_tips = {}
+    for i in range(1, len(snapshot.patches)):
+        patch = snapshot.patches[i]
+        if patch.sha is None:
+            continue
+        tip = patch.sha
+        base = new_tips.get(i - 1, patch.base)
+        try:
+            if i - 1 in new_tips:
+                tip = replayer.replay(patch.name, patch.commits, base)
+            if i in fixups:
+                tip = replayer.pick(patch.name, fixups[i], tip)
+        except ReplayConflict as conflict:
+            return [], conflict
+        if tip != patch.sha:
+            new_tips[i] = tip
+            updates.append((patch, tip, base))
+    return updates, None
+
+
+'''
+Gives the commits in messages (sha -> message) a new message and rebuilds
+every patch stacked on a rewritten one. No tree changes, so nothing is merged
+and nothing can conflict. Returns (PatchStatus, new tip, new base) for every
+patch that moved, in stack order.
+'''
+def reword(git, snapshot, messages):
+    replayer = Replayer(git)
+    # one cat-file for the whole stack rather than one per patch
+    replayer.load([commit.sha for patch in snapshot.patches for commit in patch.commits] +
+                  [patch.base for patch in snapshot.patches if patch.base is not None])
+    updates = []
+    new_tips = {}
+    for i in range(1, len(snapshot.patches)):
+        patch = snapshot.patches[i]
+        parent = snapshot.patches[i - 1]
+        if patch.sha is None or len(patch.commits) == 0:
+            continue
+        onto = patch.base
+        if i - 1 in new_tips and patch.base == parent.sha:
+            # follow the parent only if it was sitting on it to begin with
+            onto = new_tips[i - 1]
+        reworded = any(commit.sha in messages for commit in patch.commits)
+        if onto is None or (onto == patch.base and not reworded):
+            continue
+        new_tips[i] = replayer.replay(patch.name, patch.commits, onto, messages)
+        updates.append((patch, new_tips[i], onto))
+    return updates
+
+
+'''
+Trial-replays every patch onto its parent's current tip at the same time.
+Nothing is moved: the only side effect is unreferenced objects that git gc
+will collect. Returns a (PatchStatus, ReplayConflict or None) per patch.
+'''
+def check(git, snapshot, jobs=None):
+    require_merge_tree(git)
+
+    def trial(i):
+        patch = snapshot.patches[i]
+        parent = snapshot.patches[i - 1]
+        if patch.sha is None or parent.sha is None or patch.base == parent.sha:
+            return patch, None
+        try:
+            # each worker gets its own object cache, git itself is the shared state
+            Replayer(git).replay(patch.name, patch.commits, parent.sha)
+        except ReplayConflict as conflict:
+            return patch, conflict
+        return patch, None
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(trial, range(1, len(snapshot.patches))))
@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
 
-from git import Repo
 import os
-import re
-import subprocess
 import sys
+import time
+
+from . import trace
+from .journal import Journal, journaled
+from .plumbing import Git, GitError
+from .refs import HEADS_PREFIX, REMOTES_PREFIX, RefStore, find_git_dir
+from .stackfile import StackEntry, Stacks, parse
+from .worktrees import WorktreePool, has_linked_worktrees, list_worktrees
 
 class Color:
     END = '\033[0m'
@@ -12,8 +17,6 @@ class Color:
     GREY = '\033[30m'
     RED = '\033[31m'
 
-MAX_COMMITS = 15
-
 '''
 Gack's view of a git repo.
 A Gack is a stack of git branches/refs.
@@ -22,63 +25,206 @@ You can push and pop patches in the stack.
 '''
 class GackRepo:
     GACK_DIR = os.path.join('.git', 'gack')
-    STACK_PATH = os.path.join(GACK_DIR, 'stack')
-    DIFF_REVISION_RE = r'Differential Revision:\s+([a-z]+://[^\s]+/(D[0-9]+))'
+    # one revision cache per named stack
+    CACHE_DIR = os.path.join(GACK_DIR, 'cache')
+    LEGACY_REVISIONS_PATH = os.path.join(GACK_DIR, 'revisions')
+    DAEMON_SOCKET_PATH = os.path.join(GACK_DIR, 'daemon.sock')
+    WORKTREES_PATH = os.path.join(GACK_DIR, 'worktrees')
+    JOURNAL_PATH = os.path.join(GACK_DIR, 'journal')
 
     def __init__(self):
         if not os.path.exists(os.path.join(os.getcwd(), '.git')):
             raise Exception('Not a git repo!')
-        self._repo = Repo.init(os.getcwd())
+        # Nothing here talks to git yet: commands that never need GitPython
+        # (init, edit, pop, ...) should not pay for importing it
+        self._work_dir = os.getcwd()
+        self._git = Git(self._work_dir)
+        self._git_dir, self._common_dir = find_git_dir(self._work_dir)
+        self._refs = RefStore(self._git_dir, self._common_dir)
+        self._stacks = Stacks(self._path(GackRepo.GACK_DIR))
+        if self._stacks.migrate() and os.path.exists(self._path(GackRepo.LEGACY_REVISIONS_PATH)):
+            os.remove(self._path(GackRepo.LEGACY_REVISIONS_PATH))
+        self._stack_file = self._stacks.file()
+        self._repo_cache = None
         self._stack_cache = None
+        self._stack_entries = {}
+        self._stack_positions = None
+        self._snapshot_cache = None
+        self._journal = Journal(self._path(GackRepo.JOURNAL_PATH))
+        # journaled operations in progress; only the outermost one is recorded
+        self._journal_depth = 0
+        # what moves refs right now, for their reflogs
+        self._operation = None
+
+    @property
+    def _repo(self):
+        if self._repo_cache is None:
+            from git import Repo
+            if trace.recorder is not None:
+                from git.cmd import Git as GitCommand
+                trace.instrument_gitpython(GitCommand)
+            self._repo_cache = Repo.init(self._work_dir)
+        return self._repo_cache
+
+    def refresh(self):
+        # Forget everything read from refs and the stack file; for long-lived
+        # instances such as the `gack serve` daemon. The active stack is read
+        # again too, another gack may have switched it
+        self._refs.invalidate()
+        self._stacks = Stacks(self._path(GackRepo.GACK_DIR))
+        self._stack_file = self._stacks.file()
+        self._stack_cache = None
+        self._stack_entries = {}
+        self._stack_positions = None
+        self._snapshot_cache = None
 
     @property
     def is_initialized(self):
-        return os.path.exists(self._path(GackRepo.STACK_PATH))
+        return self._stack_file.exists
 
     def initialize_repo(self, stack_root):
         if self.is_initialized:
             raise Exception('This repo is already initialized!')
-        if not os.path.exists(self._path(GackRepo.GACK_DIR)):
-            os.mkdir(GackRepo.GACK_DIR)
+        os.makedirs(os.path.dirname(self._stacks.path()), exist_ok=True)
+        self._stack_file.write([StackEntry(stack_root)])
+
+    @journaled('stacks')
+    def new_stack(self, name, stack_root):
+        self._stacks.check_name(name)
+        if self._stacks.file(name).exists:
+            print('Cannot create stack {}: it already exists'.format(name))
+            return
+        self._switch_stack(name)
+        self.initialize_repo(stack_root)
+        print('Created stack {} on {} and switched to it'.format(name, stack_root))
+
+    def switch_stack(self, name):
+        if not self._stacks.file(name).exists:
+            print('Cannot switch: no stack named {}'.format(name))
+            return
+        self._switch_stack(name)
+        print('Switched to stack {}'.format(name))
+        if self._find_current_patch_index() < 0:
+            print('The current branch is not in it, check out {} or one of its patches'.format(self._stack[0]))
+
+    def _switch_stack(self, name):
+        self._stacks.switch(name)
+        self.refresh()
+
+    @journaled('stacks')
+    def delete_stack(self, name):
+        if name == self._stacks.active:
+            print('Cannot delete stack {}: it is the active stack'.format(name))
+        elif not self._stacks.file(name).exists:
+            print('Cannot delete: no stack named {}'.format(name))
+        else:
+            os.remove(self._stacks.path(name))
+            if os.path.exists(self._cache_path(name)):
+                os.remove(self._cache_path(name))
+
+    def print_stacks(self):
+        from .cache import RevisionCache
+        from .status import snapshot_stacks
+
+        names = self._stacks.names()
+        if len(names) == 0:
+            print('No stacks yet, run `gack init` to create one')
+            return
+
+        stacks = []
+        for name in names:
+            entries = self._stacks.file(name).read()
+            stacks.append((
+                [entry.name for entry in entries],
+                RevisionCache(self._cache_path(name)),
+                dict((entry.name, entry.base) for entry in entries)))
+        # every stack in one log, and none at all for patches the caches know
+        snapshots = snapshot_stacks(self._git, self._refs, stacks)
+
+        current_patch = self.current_patch
+        width = max(len(name) for name in names)
+        for name, snapshot in zip(names, snapshots):
+            patches = [patch.name for patch in snapshot.patches]
+            depth = len(patches) - 1
+            if current_patch in patches:
+                position = 'at {} {}/{}'.format(current_patch, patches.index(current_patch), depth)
+            else:
+                position = 'not checked out'
+            needs_rebase = sum(1 for patch in snapshot.patches if patch.needs_rebase)
+            if needs_rebase > 0:
+                rebase_status = self._format_color(Color.RED, '{} need rebase'.format(needs_rebase))
+            else:
+                rebase_status = self._format_color(Color.GREY, 'up to date')
+            print('{} {} {} patches on {}, {}, {}'.format(
+                '*' if name == self._stacks.active else ' ',
+                name.ljust(width), depth, patches[0] if patches else '?', position, rebase_status))
+
+    def serve(self, stop=False):
+        from .daemon import Daemon, send
 
-        if not os.path.exists(self._path(GackRepo.STACK_PATH)):
-            with open(GackRepo.STACK_PATH, 'w') as f:
-                f.write('{}\n'.format(stack_root))
+        daemon = Daemon(self, self._path(GackRepo.DAEMON_SOCKET_PATH), self._git_dir, self._common_dir)
+        if stop:
+            if send(daemon.socket_path, {'stop': True}) is None:
+                print('No gack daemon is running')
+            else:
+                print('gack daemon stopped')
+        else:
+            daemon.serve()
 
     def _path(self, path):
-        return os.path.join(self._repo.working_tree_dir, path)
+        if path.startswith(GackRepo.GACK_DIR):
+            # gack's own files are shared by every worktree of the repo
+            return os.path.join(self._common_dir, os.path.relpath(path, '.git'))
+        return os.path.join(self._work_dir, path)
 
+    @journaled('deinit')
     def deinitialize(self):
         if not self.is_initialized:
             raise Exception('This repo was never initialized!')
-        os.remove(self._path(GackRepo.STACK_PATH))
+        os.remove(self._stacks.path())
+        if os.path.exists(self._cache_path()):
+            os.remove(self._cache_path())
 
 
     @property
     def _stack(self):
         if not self._stack_cache:
-            self._stack_cache = []
-            with open(self._path(self.STACK_PATH)) as f:
-                while True:
-                    line = f.readline()
-                    if not line:
-                        break;
-                    self._stack_cache.append(line.strip())
-        return self._stack_cache;
-    
+            entries = self._stack_file.read()
+            self._stack_cache = [entry.name for entry in entries]
+            self._stack_entries = dict((entry.name, entry) for entry in entries)
+        return self._stack_cache
+
+    def _recorded_base(self, patch_name):
+        # Where gack last stacked the patch, None if it never has
+        if patch_name not in self._stack:
+            return None
+        entry = self._stack_entries.get(patch_name)
+        return entry.base if entry is not None else None
+
+    def _record_patches(self, records):
+        # records is a list of (patch name, base SHA, tip SHA)
+        if not self._stack:
+            raise Exception('Stack file is empty!')
+        for name, base, tip in records:
+            self._stack_entries[name] = StackEntry(name, base, tip)
+        self._update_stack_file()
+
     @property
     def current_patch(self):
-        return str(self._repo.active_branch)
+        # None when HEAD is detached
+        return self._refs.head()[0]
 
     def _find_patch_index(self, patch_name):
-        for i in range(len(self._stack)):
-            if self._stack[i] == patch_name:
-                return i
-        return -1
+        if self._stack_positions is None:
+            self._stack_positions = {}
+            for i in range(len(self._stack) - 1, -1, -1):
+                self._stack_positions[self._stack[i]] = i
+        return self._stack_positions.get(patch_name, -1)
 
     def _find_current_patch_index(self):
         return self._find_patch_index(self.current_patch)
 
+    @journaled('untrack')
     def untrack(self, branch, delete=False):
         patch_index = self._find_patch_index(branch)
         current_patch_index = self._find_current_patch_index()
@@ -91,7 +237,8 @@ class GackRepo:
             self._update_stack_file()
 
             if delete:
-                self._repo.delete_head(branch, force=True)
+                self._git.run('branch', '-D', branch)
+                self._refs.invalidate()
 
     def diff(self):
         current_patch_index = self._find_current_patch_index()
@@ -130,6 +277,7 @@ class GackRepo:
         else:
             self._check_out(self._stack[current_patch_index - 1])
 
+    @journaled('push')
     def push_one(self, rebase):
         current_patch_index = self._find_current_patch_index()
         if current_patch_index < 0:
@@ -139,10 +287,11 @@ class GackRepo:
         else:
             base_patch = self.current_patch
             patch = self._stack[current_patch_index + 1]
-            self._check_out(patch)
-            if rebase:
-                self._rebase(base_patch)
+            work_dir = self._check_out(patch)
+            if rebase and work_dir is not None:
+                self._rebase(base_patch, work_dir)
 
+    @journaled('push')
     def push_existing_branch(self, branch_name, rebase):
         current_patch_index = self._find_current_patch_index()
         next_patch_index = self._find_patch_index(branch_name)
@@ -154,42 +303,97 @@ class GackRepo:
             base_patch = self.current_patch
             self._stack.insert(current_patch_index + 1, branch_name)
             self._update_stack_file()
-            self._check_out(branch_name)
-            if rebase:
-                self._rebase(base_patch)
+            work_dir = self._check_out(branch_name)
+            if rebase and work_dir is not None:
+                self._rebase(base_patch, work_dir)
 
+    @journaled('push')
     def push_new_branch(self, branch_name):
         current_patch_index = self._find_current_patch_index()
         next_patch_index = self._find_patch_index(branch_name)
         if current_patch_index < 0:
             print('Cannot push: current branch not tracked in gack')
         else:
-            self._repo.create_head(branch_name, commit=self.current_patch)
+            base = self._refs.head()[1]
+            self._git.run('branch', branch_name, base)
+            self._refs.invalidate()
             self._stack.insert(current_patch_index + 1, branch_name)
-            self._update_stack_file()
+            self._record_patches([(branch_name, base, base)])
             self._check_out(branch_name)
 
     def _update_stack_file(self):
-        if not os.path.exists(self._path(GackRepo.STACK_PATH)):
+        if not self._stack_file.exists:
             raise Exception('Stack file does not exist!')
-        with open(GackRepo.STACK_PATH, 'w') as f:
-            for patch in self._stack:
-                f.write('{}\n'.format(patch))
-
-    def _find_branch(self, branch_name):
-        for branch in self._repo.branches:
-            if str(branch) == branch_name:
-                return branch
+        self._stack_file.write([self._stack_entries.get(patch) or StackEntry(patch) for patch in self._stack])
+        self._stack_positions = None
+        self._snapshot_cache = None
 
     def _check_out(self, branch):
-        self._find_branch(branch).checkout()
+        # Returns the work dir branch is now checked out in, or None
+        if self._refs.read(HEADS_PREFIX + branch) is None:
+            raise Exception('No branch named {}'.format(branch))
+        pool = self._worktree_pool()
+        if not pool.enabled:
+            self._git.run('checkout', branch)
+            return self._work_dir
+
+        work_dir = pool.acquire(branch, self._work_dir)
+        if work_dir is None:
+            print('Cannot check out {}: every gack worktree has local changes'.format(branch))
+        elif work_dir != self._work_dir:
+            print('{} is checked out in {}'.format(branch, work_dir))
+            if os.environ.get('GACK_CD_FILE'):
+                # for a shell function that changes into the worktree
+                with open(os.environ['GACK_CD_FILE'], 'w') as f:
+                    f.write(work_dir)
+        return work_dir
+
+    def _worktree_pool(self):
+        main_work_dir = os.path.dirname(self._common_dir)
+        return WorktreePool(self._git, self._path(GackRepo.WORKTREES_PATH), main_work_dir)
 
-    def _rebase(self, branch):
-        self._repo.git.rebase('--fork-point', branch)
+    def worktrees(self, enable=None, disable=False, root=None):
+        pool = self._worktree_pool()
+        if enable is not None:
+            pool.enable(enable, root)
+            print('Patches will be checked out into up to {} worktrees under {}'.format(enable, pool.state['root']))
+        elif disable:
+            if not pool.enabled:
+                print('Worktree pool is not enabled')
+                return
+            for path in pool.disable():
+                print('Kept {}: it has local changes'.format(path))
+        elif not pool.enabled:
+            print('Worktree pool is not enabled, enable it with `gack worktrees --enable <size>`')
+        else:
+            branches = dict((path, branch) for branch, path in list_worktrees(self._git).items())
+            print('Up to {} worktrees under {}, most recently used first:'.format(pool.state['size'], pool.state['root']))
+            for path, _ in pool.worktrees:
+                print('{} {}'.format(path, branches.get(path, self._format_color(Color.GREY, '(detached)'))))
+
+    def _rebase(self, branch, work_dir=None):
+        # Rebases the patch checked out in work_dir, this worktree by default, onto branch
+        if work_dir is None or work_dir == self._work_dir:
+            git = self._git
+            patch = self.current_patch
+            rebase = self._repo.git.rebase
+        else:
+            git = Git(work_dir)
+            patch = RefStore(*find_git_dir(work_dir)).head()[0]
+            rebase = lambda *args: git.run('rebase', *args)
+        base = self._recorded_base(patch)
+        if base is not None and git.run_with_status('merge-base', '--is-ancestor', base, 'HEAD', check=False)[0] == 0:
+            # exactly the commits gack stacked, no reflog guesswork
+            rebase('--onto', branch, base)
+        else:
+            rebase('--fork-point', branch)
+        self._refs.invalidate()
+        self._record_patches([(patch, self._refs.resolve(branch)[1], self._refs.resolve(patch)[1])])
 
     def _format_color(self, color, some_string):
         return color + some_string + Color.END
 
+    @journaled('rebase')
     def rebase_one(self):
         current_patch_index = self._find_current_patch_index()
         if current_patch_index < 0:
@@ -200,18 +404,519 @@ class GackRepo:
             base_patch = self.current_patch
             self._shell_out(['git', 'rebase', '-i', self._stack[current_patch_index - 1]], check=False)
 
+    @journaled('restack')
+    def restack(self, all=False):
+        # Returns False if a patch could not be restacked
+        current_patch_index = self._find_current_patch_index()
+        if current_patch_index < 0:
+            print('Cannot restack: current branch not tracked in gack')
+            return False
+        elif all:
+            start, end = 1, len(self._stack)
+        elif current_patch_index == 0:
+            print('Cannot restack bottom of stack!')
+            return False
+        else:
+            start, end = current_patch_index, current_patch_index + 1
+
+        from .replay import restack
+
+        # the patch ranges are needed, so walk history rather than use the cache
+        snapshot = self._walk_stack()
+        updates, conflict = restack(self._git, snapshot, start, end)
+        if not self._move_patches(updates):
+            return False
+        self._report_restack(updates, conflict)
+        return conflict is None
+
+    def _report_restack(self, updates, conflict):
+        for patch, new_sha, _ in updates:
+            print('Restacked {} ({} -> {})'.format(patch.name, patch.sha[:12], new_sha[:12]))
+
+        if conflict is not None:
+            print(self._format_color(Color.RED, 'Cannot restack {}: conflicts in'.format(conflict.patch)))
+            for path in conflict.paths:
+                print('  {}'.format(path))
+            print('Resolve it with `gack push --rebase` onto its parent, then restack again')
+        elif len(updates) == 0:
+            print('Stack is already up to date')
+
+    @journaled('sync')
+    def sync(self):
+        # Fetches the stack root, restacks every patch onto it and publishes
+        # them all: one fetch and one push, however deep the stack is.
+        # Returns False if anything was left undone.
+        from .replay import restack
+        from .sync import fetch_root, push_atomic, root_upstream, tracking_ref
+
+        root = self._stack[0]
+        root_ref, root_sha = self._refs.resolve(root)
+        if root_ref is None:
+            print('Cannot sync: no branch named {}'.format(root))
+            return False
+        upstream = root_upstream(self._git, root_ref)
+        if upstream is None:
+            print('Cannot sync: {} does not track a remote branch'.format(root))
+            return False
+
+        # what the remote held before the sync, as last seen; a branch someone
+        # else has moved since then will not be overwritten
+        leases = dict((patch, self._refs.read(tracking_ref(upstream.remote, patch))) for patch in self._stack[1:])
+
+        try:
+            fetch_root(self._git, upstream)
+        except GitError as e:
+            print(self._format_color(Color.RED, 'Cannot sync: fetching {} failed'.format(upstream.remote)))
+            print(e.stderr.strip())
+            return False
+        self._refs.invalidate()
+
+        fetched_sha = self._refs.read(upstream.tracking_ref)
+        if root_ref.startswith(HEADS_PREFIX) and fetched_sha != root_sha:
+            merge_base = self._git.run('merge-base', root_sha, fetched_sha).strip()
+            if merge_base == root_sha:
+                if not self._move_branches([(root, root_ref, root_sha, fetched_sha)]):
+                    return False
+                print('Updated {} ({} -> {})'.format(root, root_sha[:12], fetched_sha[:12]))
+            elif merge_base != fetched_sha:
+                print(self._format_color(Color.RED, 'Cannot sync: {} has diverged from {}'.format(
+                    root, upstream.tracking_ref[len(REMOTES_PREFIX):])))
+                return False
+
+        updates, conflict = restack(self._git, self._walk_stack(), 1, len(self._stack))
+        if not self._move_patches(updates):
+            print('Nothing was pushed')
+            return False
+        self._report_restack(updates, conflict)
+        if conflict is not None:
+            print('Nothing was pushed')
+            return False
+
+        pushes = []
+        for patch in self._stack[1:]:
+            sha = self._refs.resolve(patch)[1]
+            if sha is not None and sha != leases[patch]:
+                pushes.append((patch, sha, leases[patch]))
+        if len(pushes) == 0:
+            print('{} is already up to date'.format(upstream.remote))
+            return True
+
+        success, results = push_atomic(self._git, upstream.remote, pushes)
+        for result in results:
+            patch = result.refname[len(HEADS_PREFIX):] if result.refname else None
+            if result.flag != '!':
+                print('Pushed {} ({})'.format(patch, result.summary))
+            elif patch is not None:
+                print(self._format_color(Color.RED, 'Cannot push {}: {}'.format(patch, result.summary)))
+            else:
+                print(self._format_color(Color.RED, 'Cannot push: {}'.format(result.summary)))
+        if not success:
+            print('Nothing was pushed to {}'.format(upstream.remote))
+        return success
+
+    @journaled('move')
+    def move(self, patch_name, index):
+        # Returns False if the patch could not be moved
+        patch_index = self._find_patch_index(patch_name)
+        if patch_index < 0:
+            print('Cannot move: {} not tracked in gack'.format(patch_name))
+        elif patch_index == 0:
+            print('Cannot move bottom of stack!')
+        elif index < 1 or index >= len(self._stack):
+            print('Cannot move {}: position must be between 1 and {}'.format(patch_name, len(self._stack) - 1))
+        else:
+            order = list(range(len(self._stack)))
+            order.insert(index, order.pop(patch_index))
+            return self._reorder(order)
+        return False
+
+    @journaled('swap')
+    def swap(self, patch_name=None):
+        # Swaps a patch, the current one by default, with the patch below it;
+        # returns False if they could not be swapped
+        if patch_name is None:
+            patch_name = self.current_patch
+        patch_index = self._find_patch_index(patch_name) if patch_name is not None else -1
+        if patch_index < 0:
+            print('Cannot swap: {} not tracked in gack'.format(patch_name or 'current branch'))
+        elif patch_index < 2:
+            print('Cannot swap {}: there is no patch below it'.format(patch_name))
+        else:
+            order = list(range(len(self._stack)))
+            order[patch_index - 1], order[patch_index] = order[patch_index], order[patch_index - 1]
+            return self._reorder(order)
+        return False
+
+    def _reorder(self, order):
+        from .replay import reorder
+
+        snapshot = self._walk_stack()
+        missing = [patch.name for patch in snapshot.patches if patch.sha is None]
+        if len(missing) > 0:
+            print('Cannot reorder: no branch named {}'.format(', '.join(missing)))
+            return False
+        updates, conflict = reorder(self._git, snapshot, order)
+        if conflict is not None:
+            print(self._format_color(Color.RED, 'Cannot reorder: {} conflicts in'.format(conflict.patch)))
+            for path in conflict.paths:
+                print('  {}'.format(path))
+            print('Nothing was changed')
+            return False
+
+        # the stack file gets its new order when _move_patches records the new tips
+        stack = [self._stack[i] for i in order]
+        original = list(self._stack)
+        self._stack[:] = stack
+        self._stack_positions = None
+        if len(updates) == 0:
+            self._update_stack_file()
+        elif not self._move_patches(updates):
+            # the stack file keeps its old order too
+            self._stack[:] = original
+            self._stack_positions = None
+            return False
+        for patch, new_sha, _ in updates:
+            print('Moved {} ({} -> {})'.format(patch.name, patch.sha[:12], new_sha[:12]))
+        print(' '.join(stack))
+        return True
+
+    @journaled('absorb')
+    def absorb(self):
+        # Turns working tree changes to lines a patch at or below the current
+        # one last touched into a fixup commit on that patch, and restacks
+        # everything above. Changes that cannot be traced to exactly one
+        # patch stay in the working tree; the index is reset to the new HEAD.
+        # Returns False if it could not absorb and changed nothing.
+        from .absorb import assign_hunks, file_lengths, fixup_tree, format_patch, line_owners, parse_diff
+        from .replay import fixup
+
+        current_patch_index = self._find_current_patch_index()
+        if current_patch_index < 0:
+            print('Cannot absorb: current branch not tracked in gack')
+            return False
+        elif current_patch_index == 0:
+            print('Cannot absorb into bottom of stack!')
+            return False
+
+        snapshot = self._walk_stack()
+        patches = snapshot.patches[:current_patch_index + 1]
+        missing = [patch.name for patch in patches[1:] if patch.sha is None]
+        if len(missing) > 0:
+            print('Cannot absorb: no branch named {}'.format(', '.join(missing)))
+            return False
+        # line ownership is only meaningful along one straight history; the
+        # first patch may still be behind the root, below that history
+        stale = [patch.name for patch in patches[2:] if patch.needs_rebase]
+        if len(stale) > 0:
+            print('Cannot absorb: {} need rebase, run `gack restack` first'.format(', '.join(stale)))
+            return False
+
+        head = patches[-1].sha
+        file_diffs = parse_diff(self._git.run('diff', '-U0', '--no-color', '--no-renames', '--no-ext-diff', head))
+        paths = sorted(set(file_diff.path for file_diff in file_diffs if file_diff.path is not None and file_diff.hunks))
+        if len(paths) == 0:
+            print('Nothing to absorb')
+            return True
+
+        owners = line_owners(self._git, head, patches[1].base or patches[0].sha, file_lengths(self._git, head, paths))
+        patch_of = dict((commit.sha, i) for i in range(1, len(patches)) for commit in patches[i].commits)
+        assigned, left = assign_hunks(file_diffs, owners, patch_of)
+
+        fixups = {}
+        for index, file_hunks in assigned.items():
+            tree = fixup_tree(self._git, self._git_dir, head, format_patch(file_hunks))
+            subject = patches[index].commits[0].message.split('\n', 1)[0]
+            fixups[index] = self._git.run('commit-tree', tree, '-p', head, input='fixup! {}\n'.format(subject)).strip()
+
+        updates, conflict = fixup(self._git, snapshot, fixups)
+        if conflict is not None:
+            print(self._format_color(Color.RED, 'Cannot absorb: {} conflicts in'.format(conflict.patch)))
+            for path in conflict.paths:
+                print('  {}'.format(path))
+            print('Nothing was changed')
+            return False
+        if not self._move_patches(updates, keep_work_dir=True):
+            return False
+
+        for index in sorted(assigned):
+            hunks = sum(len(hunks) for _, hunks in assigned[index])
+            print('Absorbed {} hunk{} into {}'.format(hunks, '' if hunks == 1 else 's', patches[index].name))
+        for patch, new_sha, _ in updates:
+            if snapshot.patches.index(patch) > current_patch_index:
+                print('Restacked {} ({} -> {})'.format(patch.name, patch.sha[:12], new_sha[:12]))
+        if left > 0:
+            print('{} hunk{} left in the working tree'.format(left, '' if left == 1 else 's'))
+        return True
+
+    def export_stack(self, path, format=None, jobs=None):
+        from .series import DEFAULT_FORMAT, Series, export_series
+
+        snapshot = self._walk_stack()
+        missing = [patch.name for patch in snapshot.patches[1:] if patch.sha is None]
+        if len(missing) > 0:
+            print('Cannot export: no branch named {}'.format(', '.join(missing)))
+            return
+        # each patch is exported against its parent's tip, which has to be its
+        # base; the first one against its own base, even if the root moved on
+        stale = [patch.name for patch in snapshot.patches[2:] if patch.needs_rebase]
+        if len(stale) > 0:
+            print('Cannot export: {} need rebase, run `gack restack` first'.format(', '.join(stale)))
+            return
+        if os.path.isdir(path) and len(os.listdir(path)) > 0:
+            print('Cannot export: {} is not empty'.format(path))
+            return
+
+        patches = [(patch.name, patch.base, patch.sha) for patch in snapshot.patches[1:]]
+        series = Series(self._stacks.active, format or DEFAULT_FORMAT, self._stack[0], patches)
+        export_series(self._git, series, path, jobs)
+        print('Exported {} patches of stack {} to {}'.format(len(patches), series.stack, path))
+
+    @journaled('import')
+    def import_stack(self, path, name=None):
+        from .series import ZERO_SHA, Series, import_series
+
+        series = Series.read(path)
+        name = name or series.stack
+        self._stacks.check_name(name)
+        if self._stacks.file(name).exists:
+            print('Cannot import: stack {} already exists, name another one with --stack'.format(name))
+            return
+        elif series.format != 'stream':
+            print('Cannot import: {} holds {} files, only stream series can be imported'.format(path, series.format))
+            return
+
+        # (refname, new sha, old sha) for the one transaction that publishes the stack
+        updates = []
+        for patch, _, tip in series.patches:
+            sha = self._refs.read(HEADS_PREFIX + patch)
+            if sha is None:
+                updates.append((HEADS_PREFIX + patch, tip, ZERO_SHA))
+            elif sha != tip:
+                print('Cannot import: branch {} already exists'.format(patch))
+                return
+        if len(series.patches) > 0:
+            first_base = series.patches[0][1]
+            if self._git.run_with_status('cat-file', '-e', first_base + '^{commit}', check=False)[0] != 0:
+                print('Cannot import: {} is not in this repo, fetch {} first'.format(first_base[:12], series.root))
+                return
+
+        scratch_refs = import_series(self._git, series, path)
+        self._refs.invalidate()
+        mismatched = []
+        cleanup = []
+        for (patch, base, tip), refname in zip(series.patches, scratch_refs):
+            sha = self._refs.read(refname)
+            if sha is not None:
+                cleanup.append((refname, ZERO_SHA, sha))
+            # a patch without commits writes nothing
+            if sha != tip and not (sha is None and base == tip):
+                mismatched.append(patch)
+        if len(mismatched) > 0:
+            self._git.update_refs(cleanup, self._reflog_message())
+            print(self._format_color(Color.RED, 'Cannot import: {} came out different from the export'.format(', '.join(mismatched))))
+            return
+        self._git.update_refs(updates + cleanup, self._reflog_message())
+        self._refs.invalidate()
+
+        os.makedirs(os.path.dirname(self._stacks.path(name)), exist_ok=True)
+        self._stacks.file(name).write([StackEntry(series.root)] + [StackEntry(*patch) for patch in series.patches])
+        self._switch_stack(name)
+        print('Imported {} patches into stack {} and switched to it'.format(len(series.patches), name))
+
+    def check(self, jobs=None):
+        from .replay import check
+
+        snapshot = self._walk_stack()
+        conflicts = 0
+        for patch, conflict in check(self._git, snapshot, jobs):
+            if conflict is None:
+                print('{} {}'.format(patch.name, self._format_color(Color.GREY, 'clean')))
+            else:
+                conflicts += 1
+                print('{} {}'.format(patch.name, self._format_color(Color.RED, 'conflicts in:')))
+                for path in conflict.paths:
+                    print('  {}'.format(path))
+        return conflicts
+
+    def _move_patches(self, updates, keep_work_dir=False):
+        # updates is a list of (PatchStatus, new_sha, new_base); returns False
+        # if nothing could be moved, see _move_branches()
+        if len(updates) == 0:
+            return True
+        if not self._move_branches([(patch.name, patch.ref, patch.sha, new_sha) for patch, new_sha, _ in updates], keep_work_dir):
+            return False
+        self._record_patches([(patch.name, new_base, new_sha) for patch, new_sha, new_base in updates])
+        return True
+
+    def _move_branches(self, moves, keep_work_dir=False):
+        # moves is a list of (branch, refname, old_sha, new_sha); only checked
+        # out branches touch a working tree, and only once all objects exist.
+        # With keep_work_dir our own working tree is left as it is and only
+        # its index follows the new HEAD. Returns False, with nothing moved,
+        # if a working tree has local changes in the way or a ref moved
+        # under us.
+        if has_linked_worktrees(self._common_dir):
+            checked_out = list_worktrees(self._git)
+        else:
+            checked_out = {self.current_patch: self._work_dir}
+
+        # (git, old sha, new sha) for every worktree a moved branch is checked out in
+        trees = []
+        index_sha = None
+        for branch, _, old_sha, new_sha in moves:
+            if branch not in checked_out:
+                continue
+            work_dir = checked_out[branch]
+            if keep_work_dir and work_dir == self._work_dir:
+                index_sha = new_sha
+                continue
+            git = self._git if work_dir == self._work_dir else Git(work_dir)
+            trees.append((git, old_sha, new_sha))
+
+        moved = []
+        try:
+            for git, old_sha, new_sha in trees:
+                git.run('update-index', '-q', '--refresh', check=False)
+                git.run('read-tree', '-m', '-u', old_sha, new_sha)
+                moved.append((git, old_sha, new_sha))
+            self._git.update_refs(
+                [(refname, new_sha, old_sha) for _, refname, old_sha, new_sha in moves], self._reflog_message())
+        except GitError as e:
+            for git, old_sha, new_sha in moved:
+                git.run('read-tree', '-m', '-u', new_sha, old_sha)
+            print(self._format_color(Color.RED, 'Cannot move {}: nothing was moved'.format(
+                ', '.join(branch for branch, _, _, _ in moves))))
+            print(e.stderr.strip())
+            return False
+        if index_sha is not None:
+            self._git.run('read-tree', index_sha)
+        self._refs.invalidate()
+        self._snapshot_cache = None
+        return True
+
+    def _reflog_message(self):
+        return 'gack {}'.format(self._operation) if self._operation else 'gack'
+
+    def _journal_state(self, operation, names=()):
+        # Every stack file and the branch of each of their patches, plus any
+        # other names given; reads files only, git is never started
+        stacks = {}
+        names = set(names)
+        for stack in self._stacks.names():
+            try:
+                with open(self._stacks.path(stack)) as f:
+                    stacks[stack] = f.read()
+            except FileNotFoundError:
+                continue
+            names.update(entry.name for entry in parse(stacks[stack])[1])
+        return {
+            'operation': operation,
+            'time': time.time(),
+            'stack': self._stacks.active,
+            'stacks': stacks,
+            'head': self.current_patch,
+            'refs': dict((HEADS_PREFIX + name, self._refs.read(HEADS_PREFIX + name)) for name in names),
+        }
+
+    def _journal_begin(self, operation):
+        # Returns what _journal_end needs, None if this operation is not journaled
+        self._journal_depth += 1
+        if self._journal_depth > 1:
+            return None
+        self._operation = operation
+        before = self._journal_state(operation)
+        return before, self._journal.append(before)
+
+    def _journal_end(self, started):
+        self._journal_depth -= 1
+        if started is None:
+            return
+        self._operation = None
+        before, path = started
+        self._refs.invalidate()
+        after = self._journal_state(before['operation'], [refname[len(HEADS_PREFIX):] for refname in before['refs']])
+        changed = after['stacks'] != before['stacks'] or after['stack'] != before['stack'] or any(
+            after['refs'][refname] != sha for refname, sha in before['refs'].items())
+        if not changed:
+            self._journal.remove(path)
+        else:
+            self._journal.clear_redo()
+            self._journal.prune()
+
+    def undo(self):
+        self._restore_journaled(redo=False)
+
+    def redo(self):
+        self._restore_journaled(redo=True)
+
+    def _restore_journaled(self, redo):
+        # Puts back the branches and stack files of the latest journal entry,
+        # the branches in one ref transaction; the state it replaces goes to
+        # the other list
+        verb = 'redo' if redo else 'undo'
+        path, entry = self._journal.last(redo)
+        if entry is None:
+            print('Nothing to {}'.format(verb))
+            return
+        if any(os.path.exists(os.path.join(self._git_dir, name)) for name in ['rebase-merge', 'rebase-apply']):
+            print('Cannot {}: a rebase is in progress, run `git rebase --abort` first'.format(verb))
+            return
+
+        current = self._journal_state(entry['operation'], [refname[len(HEADS_PREFIX):] for refname in entry['refs']])
+        moves = []
+        for refname, sha in sorted(entry['refs'].items()):
+            # a branch that did not exist back then is left alone, not deleted
+            if sha is not None and current['refs'][refname] != sha:
+                moves.append((refname[len(HEADS_PREFIX):], refname, current['refs'][refname], sha))
+        self._operation = verb
+        try:
+            if len(moves) > 0 and not self._move_branches(moves):
+                print('Cannot {} {}'.format(verb, entry['operation']))
+                return
+        finally:
+            self._operation = None
+
+        for stack, text in sorted(entry['stacks'].items()):
+            if current['stacks'].get(stack) != text:
+                os.makedirs(os.path.dirname(self._stacks.path(stack)), exist_ok=True)
+                self._stacks.file(stack).write(parse(text)[1])
+        for stack in current['stacks']:
+            if stack not in entry['stacks']:
+                # created by the operation being undone
+                os.remove(self._stacks.path(stack))
+                if os.path.exists(self._cache_path(stack)):
+                    os.remove(self._cache_path(stack))
+        if entry['stack'] != self._stacks.active:
+            self._stacks.switch(entry['stack'])
+        self.refresh()
+        self._journal.remove(path)
+        self._journal.append(current, redo=not redo)
+
+        print('{} {}'.format('Redid' if redo else 'Undid', entry['operation']))
+        for branch, _, old_sha, new_sha in moves:
+            print('  {} ({} -> {})'.format(branch, old_sha[:12] if old_sha else 'missing', new_sha[:12]))
+        if self.is_initialized and self._find_current_patch_index() < 0 and entry['head'] in self._stack:
+            # e.g. the patch `gack push --new` created is no longer in the stack
+            self._check_out(entry['head'])
+
+    @journaled('edit')
     def edit_gack_file(self):
         if self.is_initialized:
-            self._shell_out(['vim', self._path(GackRepo.STACK_PATH)], check=False)
+            self._shell_out(['vim', self._stacks.path()], check=False)
 
     def print_stack(self, show_phab):
+        current_patch = self.current_patch
+        snapshot = None
+        if show_phab:
+            snapshot = self._snapshot()
+
         current_patch_found = False
         for i in range(len(self._stack)):
             patch = self._stack[i]
 
             output_strings = []
 
-            if patch == self.current_patch:
+            if patch == current_patch:
                 patch_string = self._format_color(Color.BOLD, patch)
                 current_patch_found = True
             elif current_patch_found:
@@ -220,95 +925,126 @@ class GackRepo:
                 patch_string = patch
             output_strings.append(patch_string)
 
-            if show_phab and i > 0:
-                diff_status_string = None
-                root_commit = self._repo.commit(rev=self._stack[0])
-
-                for commit in self._commits_in_reverse(self._stack[i], self._stack[i - 1]):
-                    if diff_status_string is None:
-                        # haven't found the diff rev string yet
-                        matches = re.search(GackRepo.DIFF_REVISION_RE, commit.message)
-                        if matches is not None:
-                            diff_status_string = self._format_color(Color.GREY, matches.group(1))
-                            # only do rebase check on patches > 1
-                            if i <= 1:
-                                break
-                    elif i > 1:
-                        if len(commit.parents) == 0:
-                            # Expecting to have parents, branch detached somehow?
-                            diff_status_string = self._format_color(Color.RED, 'Needs rebase!')
-                            break
-
-                        # already found a diff rev, do a rebase check if we're on patch > 1
-                        parent = commit.parents[0]
-                        if parent is not None and parent.name_rev == root_commit.name_rev:
-                            # current patch is rooted on patch 0, we need to rebase
-                            diff_status_string = self._format_color(Color.RED, 'Needs rebase!')
-                            break
-
-                if diff_status_string is not None:
-                    output_strings.append(diff_status_string)
+            if snapshot is not None and i > 0:
+                status = snapshot.patches[i]
+                if status.needs_rebase:
+                    output_strings.append(self._format_color(Color.RED, 'Needs rebase!'))
+                    if status.behind is not None:
+                        output_strings.append(self._format_color(
+                            Color.GREY, '({} behind {})'.format(status.behind, self._stack[i - 1])))
+                elif status.revision_url is not None:
+                    output_strings.append(self._format_color(Color.GREY, status.revision_url))
 
             print(' '.join(output_strings))
 
-    def _commits_in_reverse(self, current_patch, parent_patch):
-        current_commit = self._repo.commit(rev=current_patch)
-        parent_commit = self._repo.commit(rev=parent_patch)
-        # this can happen if one of the patches needs rebasing
-        root_commit = self._repo.commit(rev=self._stack[0])
-
-        commits_yielded = 0
-        while current_commit is not None and parent_commit is not None and \
-                root_commit.name_rev != current_commit.name_rev and \
-                parent_commit.name_rev != current_commit.name_rev:
-            yield current_commit
-
-            commits_yielded += 1
-            if commits_yielded > MAX_COMMITS or len(current_commit.parents) == 0:
-                current_commit = None
-            else:
-                current_commit = current_commit.parents[0]
+    def print_stack_json(self):
+        import json
 
-    def _get_differential_revision_in_patch(self, patch_index):
-        prev_patch = None
-        if patch_index > 0:
-            prev_patch = self._stack[patch_index - 1]
+        # the revision cache makes this free of git processes on an unchanged stack
+        snapshot = self._snapshot()
+        current_patch = self.current_patch
+        patches = []
+        for i, status in enumerate(snapshot.patches):
+            patches.append({
+                'index': i,
+                'name': status.name,
+                'sha': status.sha,
+                'base': status.base,
+                'commit_count': status.commit_count,
+                'revision': status.revision,
+                'revision_url': status.revision_url,
+                'depends_on': status.depends_on,
+                'needs_rebase': status.needs_rebase,
+                'ahead': status.ahead,
+                'behind': status.behind,
+                'current': status.name == current_patch,
+            })
+        print(json.dumps({'version': 1, 'current': current_patch, 'patches': patches}, indent=2))
+
+    def _snapshot(self):
+        if self._snapshot_cache is None:
+            from .cache import RevisionCache
+
+            cache = RevisionCache(self._cache_path())
+            self._snapshot_cache = self._walk_stack(cache)
+        return self._snapshot_cache
+
+    def _cache_path(self, stack=None):
+        return os.path.join(self._path(GackRepo.CACHE_DIR), stack or self._stacks.active)
+
+    def _walk_stack(self, cache=None):
+        from .status import StackSnapshot
 
-        for commit in self._commits_in_reverse(self._stack[patch_index], prev_patch):
-            matches = re.search(GackRepo.DIFF_REVISION_RE, commit.message)
-            if matches is not None:
-                return matches.group(2)
-        return None
+        bases = dict((patch, self._recorded_base(patch)) for patch in self._stack)
+        if cache is None:
+            # the ranges are about to be replayed: a patch gack never stacked
+            # (from a v1 stack file, or `push --branch`) would otherwise run
+            # down to the root and take an amended parent's old commits along
+            for parent, patch in zip(self._stack, self._stack[1:]):
+                if bases[patch] is None:
+                    bases[patch] = self._fork_point(parent, patch)
+        return StackSnapshot(self._git, self._refs, self._stack, cache, bases)
+
+    def _fork_point(self, parent, patch):
+        # Where patch was branched off parent according to parent's reflog,
+        # as `git rebase --fork-point` finds it; None if the reflog cannot tell
+        status, output = self._git.run_with_status('merge-base', '--fork-point', parent, patch, check=False)
+        return output.strip() if status == 0 else None
+
+    def _get_differential_revision_in_patch(self, patch_index):
+        return self._snapshot().patches[patch_index].revision
 
     def _add_depends_on_if_appropriate(self):
         current_patch_index = self._find_current_patch_index()
-        if current_patch_index < 1:
+        if current_patch_index < 2:
             return
 
-        parent_diff = self._get_differential_revision_in_patch(current_patch_index - 1)
-        if parent_diff is None:
+        from .arc import depends_on_messages
+        from .replay import reword
+
+        snapshot = self._walk_stack()
+        patch = snapshot.patches[current_patch_index]
+        if patch.depends_on is not None:
+            # already has dependency
             return
+        messages = depends_on_messages(snapshot, current_patch_index, current_patch_index + 1)
+        self._move_patches(reword(self._git, snapshot, messages))
 
-        for commit in self._commits_in_reverse(
-                self._stack[current_patch_index],
-                self._stack[current_patch_index - 1]):
-            matches = re.search(r'Depends on D[0-9]+', commit.message)
-            if matches is not None:
-                # already has dependency
-                return
+    @journaled('depends')
+    def fix_depends_on(self):
+        from .arc import depends_on_messages
+        from .replay import reword
 
-        # if we get here, we did not find a dependency already marked
-        curr_commit_message = self._repo.commit(rev=self._stack[current_patch_index]).message
-        self._repo.git.commit('--amend', '-m', '{}\n\nDepends on {}'.format(curr_commit_message, parent_diff))
+        # the patch ranges are needed, so walk history rather than use the cache
+        snapshot = self._walk_stack()
+        messages = depends_on_messages(snapshot)
+        updates = reword(self._git, snapshot, messages)
+        if not self._move_patches(updates):
+            return
+        for patch, new_sha, _ in updates:
+            if any(commit.sha in messages for commit in patch.commits):
+                print('Fixed Depends on in {} ({} -> {})'.format(patch.name, patch.sha[:12], new_sha[:12]))
+            else:
+                print('Rebuilt {} ({} -> {})'.format(patch.name, patch.sha[:12], new_sha[:12]))
+        if len(updates) == 0:
+            print('Every patch already depends on its parent')
 
     def _shell_out(self, command_args, check=True):
+        import subprocess
+
         print('> {}'.format(' '.join(command_args)))
+        start = time.perf_counter()
         try:
             subprocess.check_call(command_args)
         except subprocess.CalledProcessError as e:
             print(str(e), file=sys.stderr)
             sys.exit(e.returncode)
+        finally:
+            if trace.recorder is not None:
+                # output went straight to the terminal, its size is unknown
+                trace.record(command_args, 'shell', start)
 
+    @journaled('arcdiff')
     def arc_diff(self, edit_diff):
         current_patch_index = self._find_current_patch_index()
         if current_patch_index < 0:
@@ -338,6 +1074,39 @@ class GackRepo:
 
             self._shell_out(arc_diff_command)
 
+    @journaled('arcdiff')
+    def arc_diff_all(self, message, jobs=None):
+        from .arc import UploadPipeline, with_trailers
+        from .replay import reword
+
+        # the patch ranges are needed, so walk history rather than use the cache
+        snapshot = self._walk_stack()
+        pipeline = UploadPipeline(self._git, self._work_dir, snapshot, message, jobs)
+        messages = {}
+        failed = 0
+        for upload in pipeline.run():
+            patch = upload.patch
+            if upload.skipped is not None:
+                print('{} {}'.format(patch.name, self._format_color(Color.GREY, 'skipped: ' + upload.skipped)))
+                continue
+            print('> {}'.format(' '.join(upload.command)))
+            print(upload.output, end='')
+            if upload.failed:
+                failed += 1
+                print(self._format_color(Color.RED, 'Cannot diff {}: arc exited with {}'.format(patch.name, upload.returncode)))
+            elif upload.created:
+                trailers = []
+                if upload.depends_on is not None:
+                    trailers.append('Depends on {}'.format(upload.depends_on))
+                trailers.append('Differential Revision: {}'.format(upload.revision_url))
+                messages[patch.sha] = with_trailers(patch.commits[0].message, trailers)
+
+        # record the new revisions in the patches themselves, as `arc diff` would
+        updates = reword(self._git, snapshot, messages)
+        if not self._move_patches(updates) or failed > 0:
+            sys.exit(1)
+
+    @journaled('arcland')
     def arc_land(self):
         current_patch_index = self._find_current_patch_index()
         if current_patch_index < 0:
@@ -349,3 +1118,43 @@ class GackRepo:
             self._stack.pop(current_patch_index)
             self._update_stack_file()
 
+    @journaled('arcland')
+    def arc_land_through(self, last_patch):
+        # Returns False if it stopped before landing and restacking everything
+        last_patch_index = self._find_patch_index(last_patch)
+        if last_patch_index < 0:
+            print('Cannot land: {} not tracked in gack'.format(last_patch))
+            return False
+        elif last_patch_index == 0:
+            print('Cannot land bottom of stack!')
+            return False
+
+        from .replay import restack
+
+        original_patch = self.current_patch
+        root = self._stack[0]
+        for _ in range(last_patch_index):
+            # Only the patch about to land follows the updated root, the rest
+            # of the stack is restacked once everything has landed
+            updates, conflict = restack(self._git, self._walk_stack(), 1, 2)
+            if conflict is not None:
+                self._report_restack(updates, conflict)
+                return False
+            if not self._move_patches(updates):
+                return False
+
+            patch = self._stack[1]
+            self._shell_out(['arc', 'land', patch, '--onto', root])
+            self._refs.invalidate()
+            self._stack.pop(1)
+            self._update_stack_file()
+            print('Landed {}'.format(patch))
+
+        updates, conflict = restack(self._git, self._walk_stack(), 1, len(self._stack))
+        if not self._move_patches(updates):
+            return False
+        self._report_restack(updates, conflict)
+        if original_patch in self._stack[1:] and self.current_patch != original_patch:
+            self._check_out(original_patch)
+        return conflict is None
+
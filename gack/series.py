@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+from .refs import HEADS_PREFIX
+
+HEADER = 'gack series v1'
+SERIES_FILE = 'series'
+# fast-import streams rebuild the exact commits; mbox is for reading and mailing
+FORMATS = {'stream': 'fi', 'mbox': 'mbox'}
+DEFAULT_FORMAT = 'stream'
+# where an import writes patches before they become branches
+IMPORT_PREFIX = 'refs/gack/import/'
+ZERO_SHA = '0' * 40
+
+
+'''
+A stack written out to a directory: the `series` file names the stack, its
+root and every patch with the SHAs it sits on and ends at, and each patch's
+commits go to a file of their own, numbered in stack order.
+'''
+class Series:
+
+    def __init__(self, stack, format, root, patches):
+        self.stack = stack
+        self.format = format
+        self.root = root
+        # (name, base, tip) in stack order
+        self.patches = patches
+
+    def file_name(self, index):
+        # index is 1-based, as in the stack
+        return '{:04d}.{}'.format(index, FORMATS[self.format])
+
+    def write(self, path):
+        lines = [HEADER, 'stack {}'.format(self.stack), 'format {}'.format(self.format), 'root {}'.format(self.root)]
+        for name, base, tip in self.patches:
+            lines.append('patch {} {} {}'.format(name, base, tip))
+        with open(os.path.join(path, SERIES_FILE), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    @staticmethod
+    def read(path):
+        with open(os.path.join(path, SERIES_FILE)) as f:
+            lines = f.read().splitlines()
+        if len(lines) == 0 or lines[0] != HEADER:
+            raise Exception('{} is not a gack series'.format(path))
+        fields = {}
+        patches = []
+        for line in lines[1:]:
+            key, _, value = line.partition(' ')
+            if key == 'patch':
+                patches.append(tuple(value.split()))
+            else:
+                fields[key] = value
+        return Series(fields['stack'], fields['format'], fields['root'], patches)
+
+
+def export_patch(git, format, name, base, path):
+    # Writes the commits of base..name to path
+    if format == 'stream':
+        # the branch is renamed into IMPORT_PREFIX so importing never moves
+        # a branch by itself; the first commit names its parent by SHA
+        output = git.run(
+            'fast-export', '--reference-excluded-parents', '--reencode=no',
+            '--refspec={0}{1}:{2}{1}'.format(HEADS_PREFIX, name, IMPORT_PREFIX),
+            '^' + base, HEADS_PREFIX + name, binary=True)
+    else:
+        output = git.run('format-patch', '--stdout', '{}..{}{}'.format(base, HEADS_PREFIX, name), binary=True)
+    with open(path, 'wb') as f:
+        f.write(output)
+
+
+def export_series(git, series, path, jobs=None):
+    # Every patch file is generated at the same time, one git process each
+    os.makedirs(path, exist_ok=True)
+
+    def export(i):
+        name, base, _ = series.patches[i]
+        export_patch(git, series.format, name, base, os.path.join(path, series.file_name(i + 1)))
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        list(pool.map(export, range(len(series.patches))))
+    series.write(path)
+
+
+def link_stream(stream, parent_sha, parent_ref):
+    # Points the commits of a fast-export stream whose parent is parent_sha
+    # at parent_ref instead: fast-import cannot look up a commit it wrote
+    # itself by SHA before a checkpoint, but it does track its own branches
+    old_lines = [b'from ' + parent_sha.encode() + b'\n', b'merge ' + parent_sha.encode() + b'\n']
+    chunks = []
+    pos = 0
+    while pos < len(stream):
+        end = stream.find(b'\n', pos) + 1 or len(stream)
+        line = stream[pos:end]
+        if line.startswith(b'data '):
+            # file contents and messages are copied as they are
+            end += int(line[len(b'data '):])
+            line = stream[pos:end]
+        elif line in old_lines:
+            line = line.split(b' ')[0] + b' ' + parent_ref.encode() + b'\n'
+        chunks.append(line)
+        pos = end
+    return b''.join(chunks)
+
+
+def import_series(git, series, path):
+    # Writes every commit of a stream series with one `git fast-import` and
+    # returns the refs it left under IMPORT_PREFIX
+    stream = []
+    # the last patch below that has commits of its own, and so a ref
+    parent_ref = None
+    for i, (name, base, tip) in enumerate(series.patches):
+        with open(os.path.join(path, series.file_name(i + 1)), 'rb') as f:
+            data = f.read()
+        if parent_ref is not None:
+            data = link_stream(data, base, parent_ref)
+        stream.append(data)
+        if base != tip:
+            parent_ref = IMPORT_PREFIX + name
+    stream.append(b'done\n')
+    git.run('fast-import', '--quiet', '--force', '--done', input=b''.join(stream), binary=True)
+    return [IMPORT_PREFIX + name for name, _, _ in series.patches]
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+import os
+
+HEADER = '# gack stack v2'
+UNKNOWN = '-'
+
+STACKS_DIR = 'stacks'
+ACTIVE_FILE = 'active'
+LEGACY_STACK_FILE = 'stack'
+DEFAULT_STACK = 'default'
+
+'''
+One line of the stack file: a patch (or the stack root) and, when gack knows
+them, the SHA it was last stacked on and its tip at that time.
+'''
+class StackEntry:
+
+    def __init__(self, name, base=None, tip=None):
+        self.name = name
+        self.base = base
+        self.tip = tip
+
+    def format(self):
+        if self.base is None and self.tip is None:
+            return self.name
+        return '{} {} {}'.format(self.name, self.base or UNKNOWN, self.tip or UNKNOWN)
+
+
+def parse(text):
+    # Returns (version, entries). v1 files are a bare list of branch names;
+    # v2 adds the header and optional base/tip columns, and is still meant to
+    # be edited by hand with `gack edit`.
+    version = 1
+    entries = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line == HEADER:
+            version = 2
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split()
+        shas = [None if sha == UNKNOWN else sha for sha in fields[1:3]]
+        entries.append(StackEntry(fields[0], *shas))
+    return version, entries
+
+
+def serialize(entries):
+    return '{}\n{}\n'.format(HEADER, '\n'.join(entry.format() for entry in entries))
+
+
+def active_stack_name(gack_dir):
+    try:
+        with open(os.path.join(gack_dir, ACTIVE_FILE)) as f:
+            return f.read().strip() or DEFAULT_STACK
+    except FileNotFoundError:
+        return DEFAULT_STACK
+
+
+def active_stack_path(gack_dir):
+    # The stack file gack commands work on; only reads files, for `gack prompt`
+    legacy = os.path.join(gack_dir, LEGACY_STACK_FILE)
+    if os.path.exists(legacy):
+        return legacy
+    return os.path.join(gack_dir, STACKS_DIR, active_stack_name(gack_dir))
+
+
+'''
+`.git/gack/stacks/<name>`, read and written the way git treats its own files: writes
+go to `stack.lock`, created exclusively so two gack processes cannot race,
+and are renamed over the stack file only once fully written.
+'''
+class StackFile:
+
+    def __init__(self, path):
+        self._path = path
+
+    @property
+    def exists(self):
+        return os.path.exists(self._path)
+
+    def read(self):
+        with open(self._path) as f:
+            version, entries = parse(f.read())
+        if version < 2:
+            # migrate in place; the SHAs get filled in as patches are restacked
+            self.write(entries)
+        return entries
+
+    def write(self, entries):
+        lock_path = '{}.lock'.format(self._path)
+        try:
+            fd = os.open(lock_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        except FileExistsError:
+            raise Exception('Another gack process is updating the stack; remove {} if it is stale'.format(lock_path))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(serialize(entries))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(lock_path, self._path)
+        except BaseException:
+            if os.path.exists(lock_path):
+                os.remove(lock_path)
+            raise
+
+
+'''
+The stacks of a repo. Each one is a stack file under `.git/gack/stacks/`;
+`.git/gack/active` names the one gack commands work on, the default stack
+when it is missing. Repos from before named stacks have a single
+`.git/gack/stack`, which migrate() moves into place as the default stack.
+'''
+class Stacks:
+
+    def __init__(self, gack_dir):
+        self._gack_dir = gack_dir
+        self._active = None
+
+    def migrate(self):
+        # True if there was a single-stack repo to migrate
+        legacy = os.path.join(self._gack_dir, LEGACY_STACK_FILE)
+        if not os.path.exists(legacy):
+            return False
+        os.makedirs(os.path.join(self._gack_dir, STACKS_DIR), exist_ok=True)
+        os.replace(legacy, self.path(DEFAULT_STACK))
+        return True
+
+    @property
+    def active(self):
+        if self._active is None:
+            self._active = active_stack_name(self._gack_dir)
+        return self._active
+
+    def path(self, name=None):
+        return os.path.join(self._gack_dir, STACKS_DIR, name or self.active)
+
+    def file(self, name=None):
+        return StackFile(self.path(name))
+
+    def names(self):
+        try:
+            names = os.listdir(os.path.join(self._gack_dir, STACKS_DIR))
+        except FileNotFoundError:
+            return []
+        return sorted(name for name in names if not name.endswith('.lock'))
+
+    def check_name(self, name):
+        if not name or name.startswith('.') or name.endswith('.lock') or os.sep in name or '/' in name:
+            raise Exception('Invalid stack name: {}'.format(name))
+
+    def switch(self, name):
+        self.check_name(name)
+        os.makedirs(os.path.join(self._gack_dir, STACKS_DIR), exist_ok=True)
+        tmp_path = os.path.join(self._gack_dir, '{}.tmp'.format(ACTIVE_FILE))
+        with open(tmp_path, 'w') as f:
+            f.write(name + '\n')
+        os.replace(tmp_path, os.path.join(self._gack_dir, ACTIVE_FILE))
+        self._active = name
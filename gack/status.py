@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+from collections import namedtuple
+import re
+
+DIFF_REVISION_RE = r'Differential Revision:\s+([a-z]+://[^\s]+/(D[0-9]+))'
+DEPENDS_ON_RE = r'Depends on (D[0-9]+)'
+
+Commit = namedtuple('Commit', ['sha', 'parents', 'message'])
+
+
+def first_parent_log(git, tips, exclude=()):
+    # Streams the first-parent history of tips, newest first, minus everything
+    # reachable from exclude: `git log --first-parent prev..cur` for one range.
+    # There is no cap on the number of commits; only the Commit being yielded
+    # is held here, what the caller keeps is up to the caller.
+    args = ['log', '--first-parent', '-z', '--format=%H %P%n%B'] + list(tips)
+    args.extend('^' + sha for sha in exclude)
+    for record in git.records(*args):
+        header, _, message = record.partition('\n')
+        shas = header.split()
+        yield Commit(shas[0], shas[1:], message)
+
+
+def log_stale_commits(git, snapshots):
+    # One first-parent log covering the stale patches of any number of
+    # snapshots; returns sha -> Commit. Every commit walked is kept, message
+    # included, so memory grows with the commits above the stack roots, not
+    # with the roots' history, which is never walked.
+    tips = set()
+    exclude = set()
+    for snapshot in snapshots:
+        snapshot_tips, snapshot_exclude = snapshot.log_range()
+        tips.update(snapshot_tips)
+        exclude.update(snapshot_exclude)
+    if len(tips) == 0:
+        return {}
+
+    # a stack may be rooted on another stack's patch, whose history is needed
+    commits = {}
+    for commit in first_parent_log(git, sorted(tips), sorted(exclude - tips)):
+        commits[commit.sha] = commit
+    return commits
+
+
+def snapshot_stacks(git, refs, stacks):
+    # stacks is a list of (stack, cache, bases); returns a StackSnapshot for
+    # each, all built from a single log, plus a commit count for each stack
+    # whose first patch is behind its root
+    snapshots = [StackSnapshot(git, refs, stack, cache, bases, walk=False) for stack, cache, bases in stacks]
+    commits = log_stale_commits(git, snapshots)
+    for snapshot in snapshots:
+        snapshot.walk(commits)
+    return snapshots
+
+
+'''
+Everything `gack show` needs to know about one patch.
+'''
+class PatchStatus:
+
+    def __init__(self, name, sha):
+        self.name = name
+        self.ref = None
+        self.sha = sha
+        self.base = None
+        self.commits = []
+        self.commit_count = 0
+        self.revision_url = None
+        self.revision = None
+        self.depends_on = None
+        self.on_parent = True
+        self.needs_rebase = False
+        # first-parent commits the patch has that its parent lacks and the
+        # other way round; behind is None when the parent's branch is gone
+        self.ahead = 0
+        self.behind = 0
+
+
+'''
+A point-in-time view of the whole stack, built from a fixed number of git
+invocations no matter how deep the stack is: patches are resolved through the
+RefStore without running git at all, and one `log` stream covers every
+patch's commits. The root's own history is never read; when the first patch
+is behind the root, one `rev-list --count` says by how much.
+Patches are compared by SHA only; nothing here asks git to name a commit.
+With a RevisionCache, patches whose tip and parent have not moved skip the
+history walk entirely, so an unchanged stack costs no git process at all.
+bases are the SHAs the stack file recorded each patch as stacked on; when one
+is still in the patch's history it bounds the patch exactly.
+'''
+class StackSnapshot:
+
+    def __init__(self, git, refs, stack, cache=None, bases=None, walk=True):
+        self._git = git
+        self._refs = refs
+        self._cache = cache
+        self._bases = bases or {}
+        self.patches = [PatchStatus(name, None) for name in stack]
+        # indices of the patches whose history still has to be walked
+        self.stale = []
+        if len(self.patches) == 0:
+            return
+        self._resolve_refs()
+
+        self.stale = self._load_cached()
+        if walk:
+            self.walk(log_stale_commits(git, [self]))
+
+    def walk(self, commits):
+        # commits must hold the first-parent history of every stale patch and
+        # of its parent, see log_stale_commits()
+        if len(self.patches) == 0:
+            return
+        if len(self.stale) > 0:
+            self._walk_patches(self.stale, commits)
+
+        if self._cache is not None:
+            # forget patches that are no longer tracked or whose branch is gone
+            self._cache.retain(set(patch.name for patch in self.patches if patch.sha is not None))
+            self._cache.save()
+
+    def log_range(self):
+        # (tips, exclude) of the history this snapshot still has to walk
+        if len(self.stale) == 0:
+            return set(), set()
+        root = self.patches[0]
+        tips = set()
+        for i in self.stale:
+            # the parent's own history is needed to tell where this patch begins
+            tips.add(self.patches[i].sha)
+            if self.patches[i - 1].sha is not None:
+                tips.add(self.patches[i - 1].sha)
+
+        exclude = set()
+        if root.sha is not None:
+            # the root's history can be arbitrarily long and holds no patch;
+            # how far the first patch is behind it is counted on its own
+            tips.discard(root.sha)
+            exclude.add(root.sha)
+        return tips, exclude
+
+    def _resolve_refs(self):
+        for patch in self.patches:
+            patch.ref, patch.sha = self._refs.resolve(patch.name)
+
+    def _load_cached(self):
+        stale = []
+        for i in range(1, len(self.patches)):
+            patch = self.patches[i]
+            if patch.sha is None:
+                continue
+            parent = self.patches[i - 1]
+            entry = None
+            if self._cache is not None:
+                entry = self._cache.get(patch.name, patch.sha, parent.sha)
+            if entry is None:
+                stale.append(i)
+                continue
+
+            patch.base = entry['base']
+            patch.commit_count = entry['commit_count']
+            patch.revision_url = entry['revision_url']
+            patch.revision = entry['revision']
+            patch.depends_on = entry['depends_on']
+            patch.on_parent = entry['on_parent']
+            patch.ahead = entry['ahead']
+            patch.behind = entry['behind']
+            patch.needs_rebase = not patch.on_parent
+        return stale
+
+    def _first_parent_chain(self, sha, commits):
+        while sha in commits:
+            yield commits[sha]
+            parents = commits[sha].parents
+            sha = parents[0] if parents else None
+
+    def _ahead_behind(self, sha, parent_sha, commits):
+        # Both counts come from the walked history: the first commit of the
+        # patch's chain that is also on the parent's chain is their merge base
+        if parent_sha not in commits:
+            # the parent's history was excluded from the walk
+            return sum(1 for _ in self._first_parent_chain(sha, commits)), None
+        parent_chain = {}
+        for n, commit in enumerate(self._first_parent_chain(parent_sha, commits)):
+            parent_chain[commit.sha] = n
+        ahead = 0
+        for commit in self._first_parent_chain(sha, commits):
+            if commit.sha in parent_chain:
+                return ahead, parent_chain[commit.sha]
+            ahead += 1
+        # they only meet below the walked history
+        return ahead, len(parent_chain)
+
+    def _count_behind(self, sha, parent_sha):
+        # For a patch whose parent moved on outside the walk, normally the
+        # first patch behind the root: commits are only counted, never read
+        return int(self._git.run('rev-list', '--count', '--first-parent', parent_sha, '^' + sha).strip())
+
+    def _walk_patches(self, stale, commits):
+        for i in stale:
+            patch = self.patches[i]
+            parent = self.patches[i - 1]
+
+            # Commits already owned by the parent patch end this patch's range
+            # even if the parent has moved on since this patch was stacked
+            stops = set(commit.sha for commit in self._first_parent_chain(parent.sha, commits))
+            stops.add(parent.sha)
+            if self._bases.get(patch.name) is not None:
+                stops.add(self._bases[patch.name])
+
+            base = patch.sha
+            for commit in self._first_parent_chain(patch.sha, commits):
+                if commit.sha in stops:
+                    break
+                patch.commits.append(commit)
+                base = commit.parents[0] if commit.parents else None
+            patch.base = base
+            patch.commit_count = len(patch.commits)
+
+            for commit in patch.commits:
+                if patch.revision is None:
+                    matches = re.search(DIFF_REVISION_RE, commit.message)
+                    if matches is not None:
+                        patch.revision_url = matches.group(1)
+                        patch.revision = matches.group(2)
+                if patch.depends_on is None:
+                    matches = re.search(DEPENDS_ON_RE, commit.message)
+                    if matches is not None:
+                        patch.depends_on = matches.group(1)
+
+            patch.ahead, patch.behind = self._ahead_behind(patch.sha, parent.sha, commits)
+            if patch.behind is not None:
+                # on its parent exactly when the parent's tip is in its history
+                patch.on_parent = patch.behind == 0
+            else:
+                # the walk stopped at the parent's history, the root's always
+                # does, so the patch ends right on the parent's tip or not at all
+                patch.on_parent = base == parent.sha
+                if patch.on_parent:
+                    patch.behind = 0
+                elif parent.sha is not None:
+                    patch.behind = self._count_behind(patch.sha, parent.sha)
+            patch.needs_rebase = not patch.on_parent
+
+            if self._cache is not None:
+                self._cache.put(
+                    patch.name,
+                    patch.sha,
+                    parent.sha,
+                    base=patch.base,
+                    commit_count=patch.commit_count,
+                    revision_url=patch.revision_url,
+                    revision=patch.revision,
+                    depends_on=patch.depends_on,
+                    on_parent=patch.on_parent,
+                    ahead=patch.ahead,
+                    behind=patch.behind)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+from collections import namedtuple
+
+from .refs import HEADS_PREFIX, REMOTES_PREFIX
+
+# Where the stack root comes from: the remote, the branch there, and the
+# remote-tracking ref it is fetched into
+Upstream = namedtuple('Upstream', ['remote', 'remote_ref', 'tracking_ref'])
+
+# Outcome of one ref in a push; flag is git's porcelain flag ('!' is rejected)
+PushResult = namedtuple('PushResult', ['flag', 'refname', 'summary'])
+
+
+def root_upstream(git, root_ref):
+    # The Upstream of the stack root, which is either a local branch with an
+    # upstream or a remote-tracking branch itself; None if it has neither
+    if root_ref.startswith(HEADS_PREFIX):
+        fields = git.run(
+            'for-each-ref', '--format=%(upstream:remotename)%00%(upstream:remoteref)%00%(upstream)',
+            root_ref).rstrip('\n').split('\0')
+        if len(fields) != 3 or not fields[2].startswith(REMOTES_PREFIX):
+            return None
+        return Upstream(*fields)
+    elif root_ref.startswith(REMOTES_PREFIX):
+        # remote names may contain slashes, so the longest match wins
+        for remote in sorted(git.run('remote').split(), key=len, reverse=True):
+            prefix = '{}{}/'.format(REMOTES_PREFIX, remote)
+            if root_ref.startswith(prefix):
+                return Upstream(remote, HEADS_PREFIX + root_ref[len(prefix):], root_ref)
+    return None
+
+
+def tracking_ref(remote, branch):
+    # Where the default fetch refspec keeps the remote's copy of branch
+    return '{}{}/{}'.format(REMOTES_PREFIX, remote, branch)
+
+
+def fetch_root(git, upstream):
+    # Only the root is fetched, however many branches the remote has
+    git.run('fetch', upstream.remote, '+{}:{}'.format(upstream.remote_ref, upstream.tracking_ref))
+
+
+def push_atomic(git, remote, pushes):
+    # pushes is a list of (branch, new SHA, SHA the remote is expected to
+    # hold or None if it should not have the branch yet). Every branch is
+    # leased on its expected SHA and, since the push is atomic, if any of
+    # them was moved by someone else none of them are updated.
+    # Returns (success, [PushResult]).
+    from .plumbing import GitError
+
+    args = ['push', '--atomic', '--porcelain', remote]
+    for branch, _, expected in pushes:
+        args.append('--force-with-lease={}{}:{}'.format(HEADS_PREFIX, branch, expected or ''))
+    for branch, sha, _ in pushes:
+        args.append('{}:{}{}'.format(sha, HEADS_PREFIX, branch))
+    try:
+        return True, parse_porcelain(git.run(*args))
+    except GitError as e:
+        results = parse_porcelain(e.stdout or '')
+        if len(results) == 0:
+            # nothing reached the remote, e.g. it could not be contacted
+            results = [PushResult('!', None, e.stderr.strip())]
+        return False, results
+
+
+def parse_porcelain(output):
+    # `push --porcelain` prints "<flag>\t<from>:<to>\t<summary>" per ref
+    results = []
+    for line in output.split('\n'):
+        fields = line.split('\t')
+        if len(fields) < 3:
+            continue
+        refname = fields[1].partition(':')[2]
+        results.append(PushResult(fields[0], refname, fields[2]))
+    return results
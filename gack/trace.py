@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+
+'''
+Records every git (and other) process gack runs: its argv, wall time and how
+much output it produced. Everything goes through record(), which the plumbing
+runner, _shell_out and the GitPython hook call; with tracing off, `recorder`
+is None and the only cost is that check.
+
+Enabled with `gack --trace[=summary|FILE.json] <command>` or GACK_TRACE; a
+FILE.json destination gets Chrome trace format (chrome://tracing, Perfetto).
+'''
+recorder = None
+
+
+class Span:
+
+    def __init__(self, argv, source, start, duration, output_bytes, thread):
+        self.argv = argv
+        self.source = source
+        self.start = start
+        self.duration = duration
+        self.output_bytes = output_bytes
+        self.thread = thread
+
+    @property
+    def name(self):
+        # `git log`, `git rev-parse`, `arc diff`: program plus subcommand
+        words = [os.path.basename(str(self.argv[0]))]
+        for arg in self.argv[1:]:
+            if not str(arg).startswith('-'):
+                words.append(str(arg))
+                break
+        return ' '.join(words)
+
+
+class Recorder:
+
+    def __init__(self, destination):
+        import threading
+
+        self.destination = destination
+        self.start = time.perf_counter()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def write(self, command):
+        if self.destination.endswith('.json'):
+            self._write_chrome_trace(command)
+        else:
+            self._print_summary(command)
+
+    def _print_summary(self, command):
+        total = time.perf_counter() - self.start
+        groups = {}
+        for span in self.spans:
+            group = groups.setdefault((span.source, span.name), [0, 0.0, 0.0, 0])
+            group[0] += 1
+            group[1] += span.duration
+            group[2] = max(group[2], span.duration)
+            group[3] += span.output_bytes or 0
+
+        out = sys.stderr
+        print('', file=out)
+        print('gack {}: {:.1f}ms, {} processes'.format(command, total * 1000, len(self.spans)), file=out)
+        print('{:<10} {:<24} {:>5} {:>10} {:>10} {:>10}'.format(
+            'via', 'command', 'calls', 'total ms', 'max ms', 'output'), file=out)
+        for (source, name), (calls, duration, longest, output) in sorted(
+                groups.items(), key=lambda item: -item[1][1]):
+            print('{:<10} {:<24} {:>5} {:>10.1f} {:>10.1f} {:>10}'.format(
+                source, name, calls, duration * 1000, longest * 1000, output), file=out)
+
+    def _write_chrome_trace(self, command):
+        import json
+        import threading
+
+        pid = os.getpid()
+        events = [{
+            'name': 'gack {}'.format(command),
+            'ph': 'X',
+            'ts': 0,
+            'dur': (time.perf_counter() - self.start) * 1e6,
+            'pid': pid,
+            'tid': threading.main_thread().ident,
+        }]
+        for span in self.spans:
+            events.append({
+                'name': span.name,
+                'cat': span.source,
+                'ph': 'X',
+                'ts': (span.start - self.start) * 1e6,
+                'dur': span.duration * 1e6,
+                'pid': pid,
+                'tid': span.thread,
+                'args': {'argv': [str(arg) for arg in span.argv], 'output_bytes': span.output_bytes},
+            })
+        with open(self.destination, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        print('gack: wrote trace to {}'.format(self.destination), file=sys.stderr)
+
+
+def start(destination):
+    global recorder
+    recorder = Recorder(destination or 'summary')
+
+
+def record(argv, source, start, output=None, output_bytes=None):
+    # start is a time.perf_counter() taken just before the process was started;
+    # streamed output is not kept around, so its size is passed instead
+    import threading
+
+    if output is not None:
+        output_bytes = len(output)
+    recorder.add(Span(
+        list(argv), source, start, time.perf_counter() - start,
+        output_bytes, threading.get_ident()))
+
+
+def instrument_gitpython(git_class):
+    # Wraps git.cmd.Git.execute, which every GitPython command funnels through,
+    # including the ones hidden behind attributes such as Commit.name_rev
+    if getattr(git_class.execute, '_gack_traced', False):
+        return
+    execute = git_class.execute
+
+    def traced_execute(self, command, *args, **kwargs):
+        start = time.perf_counter()
+        result = execute(self, command, *args, **kwargs)
+        output = result if isinstance(result, (str, bytes)) else None
+        if isinstance(result, tuple) and len(result) == 3:
+            output = result[1]
+        record(command if not isinstance(command, str) else command.split(), 'gitpython', start, output)
+        return result
+
+    traced_execute._gack_traced = True
+    git_class.execute = traced_execute
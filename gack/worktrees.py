@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import time
+
+from .plumbing import Git
+from .refs import HEADS_PREFIX
+
+
+def list_worktrees(git):
+    # Returns branch -> work dir for every worktree with a branch checked out
+    checked_out = {}
+    path = None
+    for line in git.run('worktree', 'list', '--porcelain').split('\n'):
+        key, _, value = line.partition(' ')
+        if key == 'worktree':
+            path = value
+        elif key == 'branch' and value.startswith(HEADS_PREFIX):
+            checked_out[value[len(HEADS_PREFIX):]] = path
+    return checked_out
+
+
+def has_linked_worktrees(common_dir):
+    # Without linked worktrees the only checked out branch is our own HEAD
+    path = os.path.join(common_dir, 'worktrees')
+    return os.path.isdir(path) and len(os.listdir(path)) > 0
+
+
+'''
+Opt-in pool of linked worktrees that patches are checked out into, so
+switching patches changes directory instead of rewriting one working tree
+(and invalidating whatever build caches it holds).
+
+Worktrees are created on first use, up to the pool size, under a directory
+next to the main worktree. Once the pool is full, the least recently used
+clean worktree is switched to the requested patch; worktrees with local
+changes are never touched. The pool is enabled by the existence of its state
+file, which remembers each worktree and when it was last used.
+'''
+class WorktreePool:
+    DEFAULT_SIZE = 4
+
+    def __init__(self, git, state_path, main_work_dir):
+        self._git = git
+        self._state_path = state_path
+        self._main_work_dir = main_work_dir
+        self._state = None
+
+    @property
+    def enabled(self):
+        return os.path.exists(self._state_path)
+
+    @property
+    def state(self):
+        if self._state is None:
+            with open(self._state_path) as f:
+                self._state = json.load(f)
+            # forget worktrees that were removed behind our back
+            self._state['worktrees'] = dict(
+                (path, used) for path, used in self._state['worktrees'].items() if os.path.isdir(path))
+        return self._state
+
+    @property
+    def worktrees(self):
+        # (path, last used) pairs, most recently used first
+        return sorted(self.state['worktrees'].items(), key=lambda item: -item[1])
+
+    def enable(self, size, root=None):
+        if root is None:
+            main = self._main_work_dir.rstrip(os.sep)
+            root = '{}.worktrees'.format(main)
+        self._state = {'size': size, 'root': os.path.realpath(root), 'worktrees': {}}
+        if os.path.exists(self._state_path):
+            with open(self._state_path) as f:
+                self._state['worktrees'] = json.load(f)['worktrees']
+        self._save()
+
+    def disable(self):
+        # Removes every clean worktree; returns the ones left behind
+        kept = []
+        for path, _ in self.worktrees:
+            if self._is_clean(path):
+                self._git.run('worktree', 'remove', path)
+            else:
+                kept.append(path)
+        os.remove(self._state_path)
+        self._state = None
+        return kept
+
+    def acquire(self, branch, current_work_dir):
+        # Returns the worktree branch is checked out in, checking it out into
+        # the pool if it is not anywhere yet, or None if the pool is full of
+        # worktrees with local changes
+        checked_out = list_worktrees(self._git)
+        if branch in checked_out:
+            path = checked_out[branch]
+        elif len(self.state['worktrees']) < self.state['size']:
+            path = self._new_path()
+            self._git.run('worktree', 'add', '-q', path, branch)
+        else:
+            path = None
+            for candidate, _ in reversed(self.worktrees):
+                if candidate != current_work_dir and self._is_clean(candidate):
+                    Git(candidate).run('checkout', '-q', branch)
+                    path = candidate
+                    break
+            if path is None:
+                return None
+
+        if path in self.state['worktrees'] or branch not in checked_out:
+            self.state['worktrees'][path] = time.time()
+            self._save()
+        return path
+
+    def _new_path(self):
+        i = 1
+        while os.path.exists(os.path.join(self.state['root'], str(i))):
+            i += 1
+        return os.path.join(self.state['root'], str(i))
+
+    def _is_clean(self, path):
+        return Git(path).run('status', '--porcelain', '--untracked-files=no').strip() == ''
+
+    def _save(self):
+        tmp_path = '{}.tmp'.format(self._state_path)
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self._state_path)